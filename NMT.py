@@ -1,12 +1,25 @@
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import contextlib
+import functools
+import itertools
+import json
+import multiprocessing
 import os
+import pickle
+import queue
 import random
 import sys
+import threading
 import time
 import numpy as np
 import tensorflow as tf
+from tensorflow.python.client import timeline
+from tensorflow.tools.graph_transforms import TransformGraph
 import re
-from nltk.translate.bleu_score import sentence_bleu
-from nltk.translate.bleu_score import SmoothingFunction
+import bleu
 
 PROCESSED_PATH = 'evdata'
 CPT_PATH = 'model'
@@ -26,25 +39,74 @@ LR = 0.5
 MAX_GRAD_NORM = 5.0
 BUCKETS = [(19, 19), (28, 28), (33, 33), (40, 43), (50, 53), (60, 63)]
 MAX_ITERATION = 30000
+TOKEN_BUDGET = None
+SAMPLER_SEED = 0
+REPLICAS = 1
+METRICS_PATH = os.path.join(CPT_PATH, 'train_metrics.jsonl')
+CHECKPOINT_PREFIX = os.path.join(CPT_PATH, 'model.ckpt')
+# the checkpoint with the lowest validation loss, which decoding uses
+BEST_CHECKPOINT_PREFIX = os.path.join(CPT_PATH, 'best', 'model.ckpt')
+CHECKPOINT_STEPS = 2000
+KEEP_CHECKPOINTS = 5
+VALIDATE_STEPS = 1000
+# the validation losses so far, early stopping picks up from them on resume
+VALIDATION_PATH = os.path.join(CPT_PATH, 'validation.json')
+# validations without a lower validation loss before training stops, 0 never stops early
+EARLY_STOP_PATIENCE = 10
+DECODE_BATCH_SIZE = 64
+PREFETCH_DEPTH = 8
+PREFETCH_WORKERS = 1
+PREPROCESS_WORKERS = os.cpu_count() or 1
+PREPROCESS_CHUNK_LINES = 10000
+EVAL_WORKERS = os.cpu_count() or 1
+BEAM_WIDTH = 1
+LENGTH_PENALTY = 0.6
+SERVER_MAX_WAIT_MS = 10
+CACHE_MAX_ENTRIES = 100000
+LAZY_BUILD = True
+# translate-file: lines buffered between its stages, and how far the input may
+# run ahead of the oldest line still waiting for its bucket to fill
+TRANSLATE_FILE_QUEUE = 1024
+TRANSLATE_FILE_WINDOW = 8192
+FROZEN_PATH = os.path.join(CPT_PATH, 'frozen.pb')
+LEXICON_PATH = os.path.join(PROCESSED_PATH, 'dict.en-vi')
+SHORTLIST_TOP_K = 10
+SHORTLIST_FREQUENT = 1000
+
+# how test() and translate() decode. incremental=False runs the unrolled
+# bucket graph, which always computes every decoder step.
+DecodeOptions = collections.namedtuple('DecodeOptions', ['beam_width', 'length_penalty', 'incremental', 'shortlist'],
+                                       defaults=[BEAM_WIDTH, LENGTH_PENALTY, True, False])
 
 
 class ChatBotModel:
-    def __init__(self, forward_only, batch_size):
+    def __init__(self, forward_only, batch_size, lazy=False, replicas=1):
+        """ With replicas > 1 the training graph is copied onto that many CPU
+        devices (see _session_config). Each replica takes a slice of the batch
+        and clips its own gradients, and their average is applied once """
         print('Loading model....')
         self.fw_only = forward_only
         self.batch_size = batch_size
+        self.lazy = lazy
+        self.replicas = replicas
 
     def _create_placeholders(self):
-        # Feeds for inputs. It's a list of placeholders
-        self.encoder_inputs = [tf.placeholder(tf.int32, shape=[None], name='encoder{}'.format(i))
-                               for i in range(BUCKETS[-1][0])]
-        self.decoder_inputs = [tf.placeholder(tf.int32, shape=[None], name='decoder{}'.format(i))
-                               for i in range(BUCKETS[-1][1] + 1)]
-        self.decoder_masks = [tf.placeholder(tf.float32, shape=[None], name='mask{}'.format(i))
+        # Feeds for inputs. It's a list of placeholders per replica
+        self.replica_inputs = []
+        for replica in range(self.replicas):
+            prefix = 'replica{}_'.format(replica) if replica else ''
+            encoder_inputs = [tf.placeholder(tf.int32, shape=[None], name='{}encoder{}'.format(prefix, i))
+                              for i in range(BUCKETS[-1][0])]
+            decoder_inputs = [tf.placeholder(tf.int32, shape=[None], name='{}decoder{}'.format(prefix, i))
                               for i in range(BUCKETS[-1][1] + 1)]
+            decoder_masks = [tf.placeholder(tf.float32, shape=[None], name='{}mask{}'.format(prefix, i))
+                             for i in range(BUCKETS[-1][1] + 1)]
+            # Our targets are decoder inputs shifted by one (to ignore <GO> symbol)
+            self.replica_inputs.append((encoder_inputs, decoder_inputs, decoder_masks, decoder_inputs[1:]))
+        self.encoder_inputs, self.decoder_inputs, self.decoder_masks, self.targets = self.replica_inputs[0]
 
-        # Our targets are decoder inputs shifted by one (to ignore <GO> symbol)
-        self.targets = self.decoder_inputs[1:]
+    def _device(self, replica):
+        return '/cpu:{}'.format(replica) if self.replicas > 1 else None
 
     def _inference(self):
         # If we use sampled softmax, we need an output projection.
@@ -68,7 +130,6 @@ class ChatBotModel:
         self.cell = tf.contrib.rnn.MultiRNNCell([single_cell for _ in range(NUM_LAYERS)])
 
     def _create_loss(self):
-        start = time.time()
         def _seq2seq_f(encoder_inputs, decoder_inputs, do_decode):
             setattr(tf.contrib.rnn.GRUCell, '__deepcopy__', lambda self, _: self)
             setattr(tf.contrib.rnn.MultiRNNCell, '__deepcopy__', lambda self, _: self)
@@ -80,30 +141,9 @@ class ChatBotModel:
                 output_projection=self.output_projection,
                 feed_previous=do_decode)
 
-        if self.fw_only:
-            self.outputs, self.losses = tf.contrib.legacy_seq2seq.model_with_buckets(
-                self.encoder_inputs,
-                self.decoder_inputs,
-                self.targets,
-                self.decoder_masks,
-                BUCKETS,
-                lambda x, y: _seq2seq_f(x, y, True),
-                softmax_loss_function=self.softmax_loss_function)
-            # If we use output projection, we need to project outputs for decoding.
-            if self.output_projection:
-                for bucket in range(len(BUCKETS)):
-                    self.outputs[bucket] = [tf.matmul(output,
-                                                      self.output_projection[0]) + self.output_projection[1]
-                                            for output in self.outputs[bucket]]
-        else:
-            self.outputs, self.losses = tf.contrib.legacy_seq2seq.model_with_buckets(
-                self.encoder_inputs,
-                self.decoder_inputs,
-                self.targets,
-                self.decoder_masks,
-                BUCKETS,
-                lambda x, y: _seq2seq_f(x, y, False),
-                softmax_loss_function=self.softmax_loss_function)
+        self._seq2seq_f = lambda x, y: _seq2seq_f(x, y, self.fw_only)
+        self.outputs = [None] * len(BUCKETS)
+        self.losses = [None] * len(BUCKETS)
 
     def _creat_optimizer(self):
         with tf.variable_scope('training') as scope:
@@ -111,57 +151,340 @@ class ChatBotModel:
 
             if not self.fw_only:
                 self.optimizer = tf.train.GradientDescentOptimizer(LR)
+                self.gradient_norms = [None] * len(BUCKETS)
+                self.train_ops = [None] * len(BUCKETS)
+
+    def build_bucket(self, bucket_id):
+        """ The unrolled seq2seq graph of a bucket, its loss and, in training,
+        its update op. This is model_with_buckets for a single bucket: the
+        first bucket built creates the variables and the others reuse them """
+        if bucket_id in self.built:
+            return
+        start = time.time()
+        encoder_size, decoder_size = BUCKETS[bucket_id]
+        losses = []
+        for replica, (encoder_inputs, decoder_inputs, decoder_masks, targets) in enumerate(self.replica_inputs):
+            with tf.device(self._device(replica)), tf.name_scope('model_with_buckets'), \
+                    tf.variable_scope(tf.get_variable_scope(), reuse=True if self.built or replica else None):
+                replica_outputs, _ = self._seq2seq_f(encoder_inputs[:encoder_size], decoder_inputs[:decoder_size])
+                losses.append(tf.contrib.legacy_seq2seq.sequence_loss(
+                    replica_outputs, targets[:decoder_size], decoder_masks[:decoder_size],
+                    softmax_loss_function=self.softmax_loss_function))
+            if not replica:
+                outputs = replica_outputs
+        self.losses[bucket_id] = losses[0] if self.replicas == 1 else tf.add_n(losses) / self.replicas
+        # If we use output projection, we need to project outputs for decoding.
+        if self.fw_only and self.output_projection:
+            outputs = [tf.matmul(output, self.output_projection[0]) + self.output_projection[1]
+                       for output in outputs]
+        self.outputs[bucket_id] = outputs
+        self._record('bucket {} seq2seq'.format(bucket_id), start)
+
+        if not self.fw_only:
+            start = time.time()
+            with tf.name_scope('training'):
                 trainables = tf.trainable_variables()
-                self.gradient_norms = []
-                self.train_ops = []
-                start = time.time()
-                for bucket in range(len(BUCKETS)):
-                    clipped_grads, norm = tf.clip_by_global_norm(tf.gradients(self.losses[bucket],
-                                                                              trainables),
-                                                                 MAX_GRAD_NORM)
-                    self.gradient_norms.append(norm)
-                    self.train_ops.append(self.optimizer.apply_gradients(zip(clipped_grads, trainables),
-                                                                         global_step=self.global_step))
-                    #print('Creating opt for bucket {} took {} seconds'.format(bucket, time.time() - start))
-                    start = time.time()
-
+                replica_grads, norms = [], []
+                for replica, loss in enumerate(losses):
+                    with tf.device(self._device(replica)):
+                        clipped_grads, norm = tf.clip_by_global_norm(
+                            tf.gradients(loss, trainables, colocate_gradients_with_ops=self.replicas > 1),
+                            MAX_GRAD_NORM)
+                    replica_grads.append(clipped_grads)
+                    norms.append(norm)
+                if self.replicas > 1:
+                    clipped_grads, norm = _average_gradients(replica_grads), tf.add_n(norms) / self.replicas
+                self.gradient_norms[bucket_id] = norm
+                self.train_ops[bucket_id] = self.optimizer.apply_gradients(zip(clipped_grads, trainables),
+                                                                           global_step=self.global_step)
+            self._record('bucket {} optimizer'.format(bucket_id), start)
+        self.built.add(bucket_id)
+
+    def _create_decoder_steps(self):
+        """ Placeholders shared by the step by step decoders of build_decoder_step """
+        self.step_inputs = tf.placeholder(tf.int32, shape=[None], name='step_inputs')
+        self.step_state = tuple(tf.placeholder(tf.float32, shape=[None, HIDDEN_SIZE], name='step_state{}'.format(i))
+                                for i in range(NUM_LAYERS))
+        self.step_k = tf.placeholder(tf.int32, shape=[], name='step_k')
+        self.shortlist = tf.placeholder(tf.int32, shape=[None], name='shortlist')
+        self.encoder_attention, self.encoder_state = [None] * len(BUCKETS), [None] * len(BUCKETS)
+        self.step_attention = [None] * len(BUCKETS)
+        self.step_outputs, self.step_greedy = [None] * len(BUCKETS), [None] * len(BUCKETS)
+        self.step_shortlist_outputs = [None] * len(BUCKETS)
+        self.step_shortlist_greedy = [None] * len(BUCKETS)
+
+    def build_decoder_step(self, bucket_id):
+        """ Graph for decoding one token at a time, sharing the variables of the
+        bucketed model. For the bucket, encoder_attention/encoder_state run the
+        encoder once, and step_outputs[bucket][0] (first step) or [1] (later
+        steps) advance the decoder by one token, returning the step_k best
+        next tokens with their log-probabilities and the new decoder state.
+        step_greedy[bucket] is the same step returning only the argmax token.
+        step_shortlist_outputs/step_shortlist_greedy only score the target
+        ids fed to the shortlist placeholder, with the matching columns of
+        proj_w and proj_b """
+        if bucket_id in self.steps_built:
+            return
+        start = time.time()
+        w, b = self.output_projection
+        encoder_size = BUCKETS[bucket_id][0]
+        with tf.variable_scope(tf.get_variable_scope(), reuse=True):
+            with tf.name_scope('decoder_step_{}'.format(bucket_id)), \
+                    tf.variable_scope('embedding_attention_seq2seq'):
+                # the same encoder embedding_attention_seq2seq builds
+                encoder_cell = tf.contrib.rnn.EmbeddingWrapper(self.cell,
+                                                               embedding_classes=ENC_VOCAB,
+                                                               embedding_size=HIDDEN_SIZE)
+                encoder_outputs, encoder_state = tf.contrib.rnn.static_rnn(
+                    encoder_cell, self.encoder_inputs[:encoder_size], dtype=tf.float32)
+                top_states = [tf.reshape(e, [-1, 1, self.cell.output_size]) for e in encoder_outputs]
+                self.encoder_attention[bucket_id] = tf.concat(top_states, 1)
+                self.encoder_state[bucket_id] = encoder_state
+
+                attention = tf.placeholder(tf.float32, shape=[None, encoder_size, self.cell.output_size],
+                                           name='step_attention')
+                self.step_attention[bucket_id] = attention
+                # The first step attends to nothing, like the unrolled decoder. Later steps
+                # recompute the attention over the state the previous step returned.
+                steps, greedy_steps, shortlist_steps, shortlist_greedy_steps = [], [], [], []
+                for initial_state_attention in [False, True]:
+                    outputs, state = tf.contrib.legacy_seq2seq.embedding_attention_decoder(
+                        [self.step_inputs], self.step_state, attention, self.cell,
+                        num_symbols=DEC_VOCAB,
+                        embedding_size=HIDDEN_SIZE,
+                        output_projection=self.output_projection,
+                        feed_previous=False,
+                        initial_state_attention=initial_state_attention)
+                    logits = tf.matmul(outputs[0], w) + b
+                    top_log_probs, top_ids = tf.nn.top_k(tf.nn.log_softmax(logits), k=self.step_k)
+                    steps.append((top_log_probs, top_ids, state))
+                    greedy_steps.append((tf.argmax(logits, axis=1, output_type=tf.int32), state))
+
+                    logits = tf.matmul(outputs[0], tf.gather(w, self.shortlist, axis=1)) + tf.gather(b, self.shortlist)
+                    top_log_probs, top_positions = tf.nn.top_k(tf.nn.log_softmax(logits), k=self.step_k)
+                    shortlist_steps.append((top_log_probs, tf.gather(self.shortlist, top_positions), state))
+                    shortlist_greedy_steps.append(
+                        (tf.gather(self.shortlist, tf.argmax(logits, axis=1, output_type=tf.int32)), state))
+                self.step_outputs[bucket_id] = steps
+                self.step_greedy[bucket_id] = greedy_steps
+                self.step_shortlist_outputs[bucket_id] = shortlist_steps
+                self.step_shortlist_greedy[bucket_id] = shortlist_greedy_steps
+        self._record('bucket {} decoder step'.format(bucket_id), start)
+        self.steps_built.add(bucket_id)
+
+    def _record(self, stage, start):
+        self.timings[stage] = time.time() - start
+        if self.graph_built:
+            print('Built {} in {:.2f}s'.format(stage, self.timings[stage]))
 
     def build_graph(self):
+        """ Build every bucket, or with lazy only the first one, which creates the
+        variables. The other buckets of a lazy model are built by build_bucket
+        and build_decoder_step the first time they are used. self.timings has
+        the seconds every stage took """
+        self.timings = collections.OrderedDict()
+        self.built, self.steps_built = set(), set()
+        self.graph_built = False
+        start = time.time()
         self._create_placeholders()
         self._inference()
         self._create_loss()
         self._creat_optimizer()
+        self._record('placeholders', start)
+        for bucket_id in [0] if self.lazy else range(len(BUCKETS)):
+            self.build_bucket(bucket_id)
+        if self.fw_only:
+            self._create_decoder_steps()
+            if not self.lazy:
+                for bucket_id in range(len(BUCKETS)):
+                    self.build_decoder_step(bucket_id)
+        self.graph_built = True
+        print('Built graph in {:.2f}s ({})'.format(
+            sum(self.timings.values()), ', '.join('{} {:.2f}s'.format(stage, seconds)
+                                                 for stage, seconds in self.timings.items())))
+
+def _average_gradients(replica_grads):
+    """ The mean over replicas of every gradient. Embedding gradients are
+    IndexedSlices, those stay sparse by concatenating the slices """
+    averaged = []
+    for grads in zip(*replica_grads):
+        if grads[0] is None:
+            averaged.append(None)
+        elif isinstance(grads[0], tf.IndexedSlices):
+            averaged.append(tf.IndexedSlices(tf.concat([grad.values for grad in grads], 0) / len(grads),
+                                             tf.concat([grad.indices for grad in grads], 0),
+                                             grads[0].dense_shape))
+        else:
+            averaged.append(tf.add_n(list(grads)) / len(grads))
+    return averaged
+
+def _session_config(replicas=1):
+    """ One CPU device per replica so that the replicas run side by side """
+    return tf.ConfigProto(device_count={'CPU': replicas}, allow_soft_placement=True)
+
+
+class FrozenModel:
+    """ The step-wise decoder saved by export(), loaded without building the
+    model in Python or restoring a checkpoint. It has the attributes of a
+    forward-only ChatBotModel that _translate_batch uses, in its own graph.
+    Only the step-wise decoders are exported, so it cannot decode --unrolled """
+    ATTRIBUTES = ['encoder_inputs', 'step_inputs', 'step_state', 'step_k', 'shortlist', 'encoder_attention',
+                  'encoder_state', 'step_attention', 'step_outputs', 'step_greedy', 'step_shortlist_outputs',
+                  'step_shortlist_greedy']
+
+    def __init__(self, path, batch_size):
+        with open(_manifest_path(path), 'r') as f:
+            manifest = json.load(f)
+        if [tuple(bucket) for bucket in manifest['buckets']] != BUCKETS:
+            raise ValueError('{} was exported with buckets {}, load them with --buckets'.format(
+                path, manifest['buckets']))
+        graph_def = tf.GraphDef()
+        with open(path, 'rb') as f:
+            graph_def.ParseFromString(f.read())
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tf.import_graph_def(graph_def, name='')
+        for attribute in self.ATTRIBUTES:
+            setattr(self, attribute, _get_tensors(self.graph, manifest['tensors'][attribute]))
+        self.batch_size = batch_size
+        self.fw_only = True
+
+    def build_decoder_step(self, bucket_id):
+        pass
+
+    def build_bucket(self, bucket_id):
+        raise ValueError('the frozen graph only has the step-wise decoder, decode without --unrolled')
+
+
+def _manifest_path(path):
+    return os.path.splitext(path)[0] + '.json'
+
+def _tensor_names(value):
+    """ The tensor names of a nested list/tuple of tensors, same nesting """
+    if isinstance(value, (list, tuple)):
+        return [_tensor_names(item) for item in value]
+    return value.name
+
+def _get_tensors(graph, names):
+    if isinstance(names, list):
+        return tuple(_get_tensors(graph, name) for name in names)
+    return graph.get_tensor_by_name(names)
+
+
+# a token is either one of the split characters or a run of anything else that
+# is not whitespace. Note that the '-< range includes the ASCII digits.
+_WORD_SPLIT_CHARS = ".,!?\"'-<>:;)("
+_TOKEN_RE = re.compile("[{0}]|[^\\s{0}]+".format(_WORD_SPLIT_CHARS))
+_DIGIT_RE = re.compile(r"\d")
+_BRACKETS_TABLE = str.maketrans('', '', '[]')
+# spaces the tokenizer put before closing and after opening punctuation
+_DETOKENIZE_RE = re.compile(r" (?=[.,!?:;)])|(?<=\() ")
+# the frozen constants export(fp16=True) stores as float16, before or after
+# fold_constants replaced a variable read with a constant
+_HALF_WEIGHTS_RE = re.compile(r'^(proj_w|.*/embedding)(/read)?$')
+
+
+class _DigitTable(dict):
+    """ str.translate table that maps every decimal digit, which is what \\d
+    matches, to '#' and leaves everything else alone """
+    def __missing__(self, code):
+        self[code] = '#' if chr(code).isdecimal() else code
+        return self[code]
+
+_DIGIT_TABLE = _DigitTable()
+
+
+class Tokenizer:
+    """ Precompiled tokenizer: drops <u>, </u>, [ and ], lowercases and splits
+    the words from the punctuation in a single regex pass """
+    def __init__(self, normalize_digits=True):
+        self.normalize_digits = normalize_digits
+
+    def tokenize(self, line):
+        if '<' in line:
+            line = line.replace('<u>', '').replace('</u>', '')
+        line = line.translate(_BRACKETS_TABLE).lower()
+        tokens = _TOKEN_RE.findall(line)
+        if self.normalize_digits and _DIGIT_RE.search(line):
+            tokens = [token.translate(_DIGIT_TABLE) for token in tokens]
+        return tokens
+
+    def tokenize_many(self, lines):
+        tokenize = self.tokenize
+        return [tokenize(line) for line in lines]
+
+_TOKENIZERS = {True: Tokenizer(True), False: Tokenizer(False)}
+
 
 def basic_tokenizer(line, normalize_digits=True):
     """ A basic tokenizer to tokenize text into tokens.
     Feel free to change this to suit your need. """
-    line = re.sub('<u>', '', line)
-    line = re.sub('</u>', '', line)
-    line = re.sub('\[', '', line)
-    line = re.sub('\]', '', line)
-    words = []
-    _WORD_SPLIT = re.compile("([.,!?\"'-<>:;)(])")
-    _DIGIT_RE = re.compile(r"\d")
-    for fragment in line.strip().lower().split():
-        for token in re.split(_WORD_SPLIT, fragment):
-            if not token:
-                continue
-            if normalize_digits:
-                token = re.sub(_DIGIT_RE, '#', token)
-            words.append(token)
-    return words
+    return _TOKENIZERS[normalize_digits].tokenize(line)
 
 
-def build_vocab(filename, normalize_digits=True):
-    in_path = os.path.join(PROCESSED_PATH, filename)
+def _read_chunks(in_path, chunk_lines=PREPROCESS_CHUNK_LINES):
+    """ Stream a file chunk_lines lines at a time. Lines are split the way
+    str.splitlines() splits them so that the output lines up with
+    in_file.read().splitlines() """
+    with open(in_path, 'r') as in_file:
+        while True:
+            lines = list(itertools.islice(in_file, chunk_lines))
+            if not lines:
+                return
+            yield [piece for line in lines for piece in line.splitlines()]
+
+
+def _tokenize_chunk(lines, normalize_digits=True):
+    """ Tokenize a chunk of lines. Returns the token counts, in first seen
+    order, and the tokens of every line joined by spaces """
+    counts = collections.Counter()
+    tokenized = []
+    for tokens in _TOKENIZERS[normalize_digits].tokenize_many(lines):
+        counts.update(tokens)
+        tokenized.append(' '.join(tokens))
+    return counts, tokenized
+
+
+def _ordered_imap(pool, func, items, in_flight):
+    """ Like pool.imap, but only ever reads in_flight items ahead of the consumer """
+    if pool is None:
+        for item in items:
+            yield func(item)
+        return
+    pending = collections.deque()
+    for item in items:
+        pending.append(pool.apply_async(func, (item,)))
+        if len(pending) >= in_flight:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def _tokenized_path(filename):
+    return os.path.join(PROCESSED_PATH, filename + '.tok')
+
+
+def _tokenize_file(filename, normalize_digits=True, pool=None):
+    """ Tokenize filename once, sharded over pool, into <filename>.tok with the
+    tokens of a line space separated. The file only appears once complete.
+    Returns the merged token counts """
+    counts = collections.Counter()
+    tokenize = functools.partial(_tokenize_chunk, normalize_digits=normalize_digits)
+    tokenized_path = _tokenized_path(filename)
+    with open(tokenized_path + '.tmp', 'w', newline='\n') as out_file:
+        for chunk_counts, tokenized in _ordered_imap(pool, tokenize,
+                                                     _read_chunks(os.path.join(PROCESSED_PATH, filename)),
+                                                     2 * PREPROCESS_WORKERS):
+            # chunks come back in order, so the merged counter keeps first seen order
+            counts.update(chunk_counts)
+            out_file.write(''.join(tokens + '\n' for tokens in tokenized))
+    os.replace(tokenized_path + '.tmp', tokenized_path)
+    return counts
+
+
+def build_vocab(filename, normalize_digits=True, pool=None):
     out_path = os.path.join(PROCESSED_PATH, 'vocab.{}'.format(filename[-2:]))
-    vocab = {}
-    with open(in_path, 'r') as f:
-        for line in f.readlines():
-            for token in basic_tokenizer(line):
-                if not token in vocab:
-                    vocab[token] = 0
-                vocab[token] += 1
+    vocab = _tokenize_file(filename, normalize_digits, pool)
 
     sorted_vocab = sorted(vocab, key=vocab.get, reverse=True)
     with open(out_path, 'w') as f:
@@ -192,40 +515,358 @@ def sentence2id(vocab, line):
     return [vocab.get(token, vocab['<unk>']) for token in basic_tokenizer(line)]
 
 
-def token2id(data, mode):
+class Shortlist:
+    """ Candidate target ids for vocabulary-restricted decoding: the top_k
+    translations in the lexicon of every source token of a batch, the
+    frequent most frequent target words and the special tokens. The lexicon
+    has one "source target probability" line per entry. Words go through
+    basic_tokenizer like the corpora, and entries outside the vocabularies
+    are skipped """
+    def __init__(self, enc_vocab, dec_vocab, path=LEXICON_PATH, top_k=SHORTLIST_TOP_K,
+                 frequent=SHORTLIST_FREQUENT):
+        probabilities = collections.defaultdict(dict)
+        with open(path, 'r') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) != 3:
+                    continue
+                try:
+                    probability = float(fields[2])
+                except ValueError:
+                    continue
+                for source in basic_tokenizer(fields[0]):
+                    if source not in enc_vocab:
+                        continue
+                    targets = probabilities[enc_vocab[source]]
+                    for target in basic_tokenizer(fields[1]):
+                        target_id = dec_vocab.get(target, DEC_VOCAB)
+                        if target_id < DEC_VOCAB:
+                            targets[target_id] = max(probability, targets.get(target_id, 0))
+        self.translations = {source_id: np.array(sorted(targets, key=targets.get, reverse=True)[:top_k],
+                                                 dtype=np.int32)
+                             for source_id, targets in probabilities.items()}
+        # the vocabulary lists the special tokens first, then the words by count
+        self.frequent = np.arange(min(max(frequent, EOS_ID + 1), DEC_VOCAB), dtype=np.int32)
+
+    def candidates(self, token_ids_list):
+        """ Sorted target ids a batch of source sentences may translate to """
+        return np.unique(np.concatenate([self.frequent] + [self.translations[token_id]
+                                                           for token_ids in token_ids_list
+                                                           for token_id in token_ids
+                                                           if token_id in self.translations]))
+
+
+class _IdsWriter:
+    """ Writes a token-id corpus as text, one sentence per line, and alongside
+    it as a flat int32 token array (<out_path>.tokens.bin) plus int64 sentence
+    offsets (<out_path>.offsets.bin) that load_data can memory-map """
+    def __init__(self, out_path):
+        self.text_file = open(out_path, 'w')
+        self.tokens_file = open(out_path + '.tokens.bin', 'wb')
+        self.offsets_file = open(out_path + '.offsets.bin', 'wb')
+        self.length = 0
+        self.offsets_file.write(np.zeros(1, dtype='<i8').tobytes())
+
+    def write_many(self, ids_list):
+        self.text_file.write(''.join(' '.join(str(id_) for id_ in ids) + '\n' for ids in ids_list))
+        lengths = np.array([len(ids) for ids in ids_list], dtype='<i8')
+        tokens = np.array([id_ for ids in ids_list for id_ in ids], dtype='<i4')
+        self.tokens_file.write(tokens.tobytes())
+        self.offsets_file.write((self.length + np.cumsum(lengths)).astype('<i8').tobytes())
+        self.length += int(lengths.sum())
+
+    def close(self):
+        # the text file is closed first so the binary files are never older than it
+        self.text_file.close()
+        self.tokens_file.close()
+        self.offsets_file.close()
+
+
+def token2id(data, mode, pool=None):
     """ Convert all the tokens in the data into their corresponding
-    index in the vocabulary. """
+    index in the vocabulary. Reuses the tokens build_vocab already wrote
+    for this file unless the file changed since, and streams them chunk by
+    chunk. """
     vocab_path = 'vocab.' + mode
     in_path = data + '.' + mode
     out_path = data + '_ids.' + mode
 
     _, vocab = load_vocab(os.path.join(PROCESSED_PATH, vocab_path))
-    in_file = open(os.path.join(PROCESSED_PATH, in_path), 'r')
-    out_file = open(os.path.join(PROCESSED_PATH, out_path), 'w')
-
-    lines = in_file.read().splitlines()
-    for line in lines:
-        if mode == 'vi':  # we only care about '<s>' and </s> in encoder
-            ids = [vocab['<s>']]
+    tokenized_path = _tokenized_path(in_path)
+    if not os.path.exists(tokenized_path) or \
+            os.path.getmtime(tokenized_path) < os.path.getmtime(os.path.join(PROCESSED_PATH, in_path)):
+        _tokenize_file(in_path, pool=pool)
+    unk_id = vocab['<unk>']
+    out_file = _IdsWriter(os.path.join(PROCESSED_PATH, out_path))
+
+    with open(tokenized_path, 'r', newline='\n') as in_file:
+        while True:
+            lines = list(itertools.islice(in_file, PREPROCESS_CHUNK_LINES))
+            if not lines:
+                break
+            ids_list = []
+            for line in lines:
+                ids = [vocab.get(token, unk_id) for token in line.split()]
+                if mode == 'vi':  # we only care about '<s>' and </s> in encoder
+                    ids = [vocab['<s>']] + ids + [vocab['<\s>']]
+                ids_list.append(ids)
+            out_file.write_many(ids_list)
+    out_file.close()
+    os.remove(tokenized_path)
+
+def _text_ids_to_binary(filename):
+    """ Write the binary tokens/offsets files for an existing text ids file """
+    path = os.path.join(PROCESSED_PATH, filename)
+    out_file = _IdsWriter(path + '.tmp')
+    with open(path, 'r') as f:
+        out_file.write_many([[int(id_) for id_ in line.split()] for line in f])
+    out_file.close()
+    os.remove(path + '.tmp')
+    for suffix in ['.tokens.bin', '.offsets.bin']:
+        os.replace(path + '.tmp' + suffix, path + suffix)
+    # the saved bucket assignment was computed from the old ids
+    if os.path.exists(_bucket_assignment_path(filename)):
+        os.remove(_bucket_assignment_path(filename))
+
+def _bucket_assignment(encode_lengths, decode_lengths, buckets=None):
+    """ The first bucket that fits each pair, -1 for pairs that fit no bucket """
+    buckets = buckets or BUCKETS
+    assignment = np.full(len(encode_lengths), -1, dtype=np.int8)
+    # walk the buckets backwards so that the smallest fitting bucket wins
+    for bucket_id in reversed(range(len(buckets))):
+        encode_max_size, decode_max_size = buckets[bucket_id]
+        assignment[(encode_lengths <= encode_max_size) & (decode_lengths <= decode_max_size)] = bucket_id
+    return assignment
+
+def _pair_lengths(data):
+    """ Encoder and decoder lengths of every (data_ids.en, data_ids.vi) pair """
+    lengths = []
+    for filename in [data + '_ids.en', data + '_ids.vi']:
+        _, offsets = _map_ids(filename)
+        if offsets is None:
+            with open(os.path.join(PROCESSED_PATH, filename), 'r') as f:
+                lengths.append(np.array([len(line.split()) for line in f], dtype=np.int64))
         else:
-            ids = []
-        ids.extend(sentence2id(vocab, line))
-        # ids.extend([vocab.get(token, vocab['<unk>']) for token in basic_tokenizer(line)])
-        if mode == 'vi':
-            ids.append(vocab['<\s>'])
-        out_file.write(' '.join(str(id_) for id_ in ids) + '\n')
+            lengths.append(np.diff(offsets))
+    size = min(len(lengths[0]), len(lengths[1]))
+    return lengths[0][:size], lengths[1][:size]
+
+def _bucket_assignment_path(filename):
+    """ Where the bucket assignment of the pairs of an ids file is saved """
+    return os.path.join(PROCESSED_PATH, filename.rsplit('.', 1)[0] + '.buckets.npz')
+
+def _write_bucket_assignment(data):
+    """ Precompute the bucket of every (data_ids.en, data_ids.vi) pair """
+    assignment = _bucket_assignment(*_pair_lengths(data))
+    np.savez(_bucket_assignment_path(data + '_ids.en'),
+             buckets=np.array(BUCKETS, dtype=np.int32), assignment=assignment)
+
+def _saved_bucket_assignment(enc_filename, dec_filename, encode_lengths, decode_lengths):
+    """ The assignment _write_bucket_assignment saved for these pairs, None if
+    it is missing, older than the binary files, for other BUCKETS, or puts
+    a pair in a bucket it does not fit """
+    path = _bucket_assignment_path(enc_filename)
+    if not os.path.exists(path) or any(
+            os.path.getmtime(path) < os.path.getmtime(os.path.join(PROCESSED_PATH, filename + '.tokens.bin'))
+            for filename in [enc_filename, dec_filename]):
+        return None
+    with np.load(path) as saved:
+        if saved['buckets'].tolist() != [list(bucket) for bucket in BUCKETS] or \
+                len(saved['assignment']) != len(encode_lengths):
+            return None
+        assignment = saved['assignment']
+    # a stale assignment would make _gather_rows write outside the rows
+    sizes = np.array(BUCKETS)[assignment]
+    assigned = assignment >= 0
+    if not ((encode_lengths <= sizes[:, 0]) & (decode_lengths <= sizes[:, 1]) | ~assigned).all():
+        return None
+    return assignment
+
+def bucket_report(encode_lengths, decode_lengths, buckets):
+    """ (pairs, real tokens, padded tokens) of every bucket and the number of
+    pairs that fit no bucket """
+    assignment = _bucket_assignment(encode_lengths, decode_lengths, buckets)
+    rows = []
+    for bucket_id, (encoder_size, decoder_size) in enumerate(buckets):
+        members = assignment == bucket_id
+        count = int(members.sum())
+        tokens = int(encode_lengths[members].sum() + decode_lengths[members].sum())
+        rows.append((count, tokens, count * (encoder_size + decoder_size)))
+    return rows, int((assignment < 0).sum())
+
+def propose_buckets(encode_lengths, decode_lengths, num_buckets, max_encode, max_decode):
+    """ At most num_buckets buckets holding every pair within (max_encode,
+    max_decode) with the fewest padded tokens. Bucket sizes grow in both
+    directions, so the buckets are nested boxes and a bucket holds the pairs
+    of its box minus those of the previous one. Dynamic programming over the
+    boxes whose sides are lengths that occur in the corpus, which is
+    quadratic in their number: keep max_encode and max_decode reasonable """
+    kept = (encode_lengths <= max_encode) & (decode_lengths <= max_decode)
+    if not kept.any():
+        raise ValueError('no pair fits in {} x {}'.format(max_encode, max_decode))
+    # empty sentences still need one step
+    encode_kept, decode_kept = np.maximum(encode_lengths[kept], 1), np.maximum(decode_lengths[kept], 1)
+    encoder_sizes, decoder_sizes = np.unique(encode_kept), np.unique(decode_kept)
+    # pairs that fit in each box
+    fits = np.zeros((len(encoder_sizes), len(decoder_sizes)), dtype=np.int64)
+    np.add.at(fits, (np.searchsorted(encoder_sizes, encode_kept), np.searchsorted(decoder_sizes, decode_kept)), 1)
+    fits = fits.cumsum(axis=0).cumsum(axis=1)
+    widths = encoder_sizes[:, None] + decoder_sizes[None, :]
+
+    # cost[i, j]: fewest tokens (real + padding) of the pairs in box (i, j)
+    # when it is the last of k buckets
+    cost = (fits * widths).astype(np.float64)
+    previous = []
+    for _ in range(1, num_buckets):
+        new_cost = np.empty_like(cost)
+        before = np.empty(cost.shape, dtype=np.int64)
+        for i in range(len(encoder_sizes)):
+            for j in range(len(decoder_sizes)):
+                costs = cost[:i + 1, :j + 1] - fits[:i + 1, :j + 1] * widths[i, j]
+                best = np.argmin(costs)
+                before[i, j] = np.ravel_multi_index(np.unravel_index(best, costs.shape), cost.shape)
+                new_cost[i, j] = costs.flat[best] + fits[i, j] * widths[i, j]
+        cost = new_cost
+        previous.append(before)
+
+    box = (len(encoder_sizes) - 1, len(decoder_sizes) - 1)
+    buckets = [box]
+    for before in reversed(previous):
+        box = np.unravel_index(before[box], cost.shape)
+        # a bucket can be its own predecessor when fewer buckets do as well
+        if box != buckets[-1]:
+            buckets.append(box)
+    return [(int(encoder_sizes[i]), int(decoder_sizes[j])) for i, j in reversed(buckets)]
+
+def _print_bucket_report(title, encode_lengths, decode_lengths, buckets):
+    rows, dropped = bucket_report(encode_lengths, decode_lengths, buckets)
+    print(title)
+    print('bucket      size    pairs    tokens    padded  padding')
+    for bucket_id, ((encoder_size, decoder_size), (count, tokens, padded)) in enumerate(zip(buckets, rows)):
+        print('{:6d}  {:>8s}  {:7d}  {:8d}  {:8d}  {:6.1%}'.format(
+            bucket_id, '{}x{}'.format(encoder_size, decoder_size), count, tokens, padded,
+            1 - tokens / padded if padded else 0))
+    tokens, padded = sum(row[1] for row in rows), sum(row[2] for row in rows)
+    print('total             {:7d}  {:8d}  {:8d}  {:6.1%}'.format(
+        sum(row[0] for row in rows), tokens, padded, 1 - tokens / padded if padded else 0))
+    print('dropped {} of {} pairs'.format(dropped, len(encode_lengths)))
+
+def suggest_buckets(num_buckets, max_encode=None, max_decode=None, output=None, data='train'):
+    """ Report how the pairs of data fill BUCKETS and propose boundaries with
+    less padding, optionally saving them as a config for --buckets """
+    encode_lengths, decode_lengths = _pair_lengths(data)
+    _print_bucket_report('Current buckets', encode_lengths, decode_lengths, BUCKETS)
+    proposed = propose_buckets(encode_lengths, decode_lengths, num_buckets,
+                               max_encode or BUCKETS[-1][0], max_decode or BUCKETS[-1][1])
+    print()
+    _print_bucket_report('Proposed buckets', encode_lengths, decode_lengths, proposed)
+    if output:
+        with open(output, 'w') as f:
+            json.dump({'buckets': proposed}, f)
+        print('Saved to ' + output)
+
+def load_buckets(path):
+    """ Replace BUCKETS with the ones of a config saved by suggest_buckets """
+    global BUCKETS
+    with open(path, 'r') as f:
+        buckets = [tuple(bucket) for bucket in json.load(f)['buckets']]
+    if not buckets or any(len(bucket) != 2 or min(bucket) < 1 for bucket in buckets):
+        raise ValueError('{}: buckets must be non-empty [encoder_size, decoder_size] pairs'.format(path))
+    if any(a[0] > b[0] or a[1] > b[1] or a == b for a, b in zip(buckets, buckets[1:])):
+        raise ValueError('{}: bucket sizes must increase'.format(path))
+    BUCKETS = buckets
 
 def process_data():
     print('Processing data')
-    build_vocab('train.en')
-    build_vocab('train.vi')
-    token2id('train', 'en')
-    token2id('train', 'vi')
-    token2id('tst2012', 'en')
-    token2id('tst2012', 'vi')
+    with multiprocessing.Pool(PREPROCESS_WORKERS) as pool:
+        build_vocab('train.en', pool=pool)
+        build_vocab('train.vi', pool=pool)
+        token2id('train', 'en', pool)
+        token2id('train', 'vi', pool)
+        token2id('tst2012', 'en', pool)
+        token2id('tst2012', 'vi', pool)
+    _write_bucket_assignment('train')
+    _write_bucket_assignment('tst2012')
+
+
+class BucketData:
+    """ The samples of one bucket stored as padded int32 matrices, one row per
+    sample. Encoder rows are already reversed the way the model reads them """
+    def __init__(self, encoder, decoder):
+        self.encoder = encoder
+        self.decoder = decoder
+
+    def __len__(self):
+        return len(self.encoder)
+
+
+def _pack_samples(samples, bucket_id):
+    """ Pad (and reverse the encoder side of) a list of [encode_ids, decode_ids]
+    samples into a BucketData """
+    encoder_size, decoder_size = BUCKETS[bucket_id]
+    encoder = np.full((len(samples), encoder_size), PAD_ID, dtype=np.int32)
+    decoder = np.full((len(samples), decoder_size), PAD_ID, dtype=np.int32)
+    for i, (encode_ids, decode_ids) in enumerate(samples):
+        encoder[i, encoder_size - len(encode_ids):] = encode_ids[::-1]
+        decoder[i, :len(decode_ids)] = decode_ids
+    return BucketData(encoder, decoder)
+
+
+def _map_ids(filename):
+    """ Memory-map the binary tokens and offsets of an ids file. Returns
+    (None, None) if they are missing or older than the text file """
+    path = os.path.join(PROCESSED_PATH, filename)
+    tokens_path, offsets_path = path + '.tokens.bin', path + '.offsets.bin'
+    if not (os.path.exists(tokens_path) and os.path.exists(offsets_path)):
+        return None, None
+    if os.path.exists(path) and os.path.getmtime(path) > os.path.getmtime(tokens_path):
+        return None, None
+    # np.memmap refuses empty files
+    if os.path.getsize(tokens_path) == 0:
+        tokens = np.zeros(0, dtype='<i4')
+    else:
+        tokens = np.memmap(tokens_path, dtype='<i4', mode='r')
+    return tokens, np.memmap(offsets_path, dtype='<i8', mode='r')
+
+
+def _gather_rows(tokens, offsets, rows, size, reverse):
+    """ Padded [len(rows), size] int32 matrix of the sentences at rows, optionally
+    reversed within the row the way the encoder reads them """
+    starts = offsets[rows]
+    lengths = offsets[rows + 1] - starts
+    matrix = np.full((len(rows), size), PAD_ID, dtype=np.int32)
+    # position of every token inside its own sentence
+    positions = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    columns = size - 1 - positions if reverse else positions
+    matrix[np.repeat(np.arange(len(rows)), lengths), columns] = tokens[np.repeat(starts, lengths) + positions]
+    return matrix
+
+
+def _load_binary_data(enc_filename, dec_filename):
+    """ load_data from the memory-mapped binary files, None if they are not there """
+    encode_tokens, encode_offsets = _map_ids(enc_filename)
+    decode_tokens, decode_offsets = _map_ids(dec_filename)
+    if encode_tokens is None or decode_tokens is None:
+        return None
+    size = min(len(encode_offsets), len(decode_offsets)) - 1
+    encode_lengths, decode_lengths = np.diff(encode_offsets[:size + 1]), np.diff(decode_offsets[:size + 1])
+    assignment = _saved_bucket_assignment(enc_filename, dec_filename, encode_lengths, decode_lengths)
+    if assignment is None:
+        assignment = _bucket_assignment(encode_lengths, decode_lengths)
+
+    data_buckets = []
+    for bucket_id, (encoder_size, decoder_size) in enumerate(BUCKETS):
+        rows = np.flatnonzero(assignment == bucket_id)
+        data_buckets.append(BucketData(_gather_rows(encode_tokens, encode_offsets, rows, encoder_size, True),
+                                       _gather_rows(decode_tokens, decode_offsets, rows, decoder_size, False)))
+    return data_buckets
 
 
-def load_data(enc_filename, dec_filename, max_training_size=None):
+def load_data(enc_filename, dec_filename, max_training_size=None, use_binary=True):
+    if use_binary:
+        data_buckets = _load_binary_data(enc_filename, dec_filename)
+        if data_buckets is not None:
+            return data_buckets
     encode_file = open(os.path.join(PROCESSED_PATH, enc_filename), 'r')
     decode_file = open(os.path.join(PROCESSED_PATH, dec_filename), 'r')
     encode, decode = encode_file.readline(), decode_file.readline()
@@ -240,58 +881,130 @@ def load_data(enc_filename, dec_filename, max_training_size=None):
                 break
         encode, decode = encode_file.readline(), decode_file.readline()
         i += 1
-    return data_buckets
-
-
-def _pad_input(input_, size):
-    return input_ + [PAD_ID] * (size - len(input_))
+    return [_pack_samples(samples, bucket_id) for bucket_id, samples in enumerate(data_buckets)]
 
 
-def _reshape_batch(inputs, size, batch_size):
-    """ Create batch-major inputs. Batch inputs are just re-indexed inputs
-    """
-    batch_inputs = []
-    for length_id in range(size):
-        batch_inputs.append(np.array([inputs[batch_id][length_id]
-                                      for batch_id in range(batch_size)], dtype=np.int32))
-    return batch_inputs
-
-
-def get_batch(data_bucket, bucket_id, batch_size=1):
-    """ Return one batch to feed into the model """
-    # only pad to the max length of the bucket
-    encoder_size, decoder_size = BUCKETS[bucket_id]
-    encoder_inputs, decoder_inputs = [], []
-
-    for _ in range(batch_size):
-        encoder_input, decoder_input = random.choice(data_bucket)
-        # pad both encoder and decoder, reverse the encoder
-        encoder_inputs.append(list(reversed(_pad_input(encoder_input, encoder_size))))
-        decoder_inputs.append(_pad_input(decoder_input, decoder_size))
-
-    # now we create batch-major vectors from the data selected above.
-    batch_encoder_inputs = _reshape_batch(encoder_inputs, encoder_size, batch_size)
-    batch_decoder_inputs = _reshape_batch(decoder_inputs, decoder_size, batch_size)
+def _make_batch(data_bucket, indices, bucket_id):
+    """ Gather the rows at indices of a BucketData into one batch-major batch """
+    decoder_size = BUCKETS[bucket_id][1]
+    batch_encoder_inputs = np.ascontiguousarray(data_bucket.encoder[indices].T)
+    batch_decoder_inputs = np.ascontiguousarray(data_bucket.decoder[indices].T)
 
     # create decoder_masks to be 0 for decoders that are padding.
-    batch_masks = []
-    for length_id in range(decoder_size):
-        batch_mask = np.ones(batch_size, dtype=np.float32)
-        for batch_id in range(batch_size):
-            # we set mask to 0 if the corresponding target is a PAD symbol.
-            # the corresponding decoder is decoder_input shifted by 1 forward.
-            if length_id < decoder_size - 1:
-                target = decoder_inputs[batch_id][length_id + 1]
-            if length_id == decoder_size - 1 or target == PAD_ID:
-                batch_mask[batch_id] = 0.0
-        batch_masks.append(batch_mask)
+    # the target of a decoder input is the decoder input shifted by 1 forward,
+    # and the last decoder input has no target at all.
+    batch_masks = np.zeros((decoder_size, len(indices)), dtype=np.float32)
+    batch_masks[:-1] = batch_decoder_inputs[1:] != PAD_ID
     return batch_encoder_inputs, batch_decoder_inputs, batch_masks
 
-def _get_random_bucket(train_buckets_scale):
-    """ Get a random bucket from which to choose a training sample """
-    rand = random.random()
-    return min([i for i in range(len(train_buckets_scale))
-                if train_buckets_scale[i] > rand])
+
+def get_batch(data_bucket, bucket_id, batch_size=1, rng=random):
+    """ Return one batch to feed into the model """
+    indices = [rng.randrange(len(data_bucket)) for _ in range(batch_size)]
+    return _make_batch(data_bucket, indices, bucket_id)
+
+class EpochSampler:
+    """ Visits every training sample exactly once per epoch. Each epoch the
+    samples of every bucket are shuffled and cut into batches, and the batches
+    of all buckets are shuffled together. With a token_budget the batch size
+    of a bucket is token_budget // (encoder_size + decoder_size) instead of
+    batch_size, so short buckets take more sentences per step. Batches are
+    always padded to their bucket shape, so that is where the step cost goes """
+    def __init__(self, bucket_sizes, batch_size=BATCH_SIZE, token_budget=None, seed=SAMPLER_SEED):
+        self.bucket_sizes = bucket_sizes
+        self.total_size = sum(bucket_sizes)
+        self.batch_sizes = [batch_size if not token_budget else max(1, token_budget // sum(BUCKETS[bucket_id]))
+                            for bucket_id in range(len(bucket_sizes))]
+        self.rng = np.random.RandomState(seed)
+        self.epoch = 0
+        self._batches = []
+        self._lock = threading.Lock()
+
+    def _shuffle_epoch(self):
+        batches = []
+        for bucket_id, size in enumerate(self.bucket_sizes):
+            order = self.rng.permutation(size)
+            batch_size = self.batch_sizes[bucket_id]
+            batches.extend((bucket_id, order[start:start + batch_size]) for start in range(0, size, batch_size))
+        # popped from the end
+        self._batches = [batches[i] for i in self.rng.permutation(len(batches))][::-1]
+
+    def skip(self, batches):
+        """ Drop the next batches, to resume where an earlier run stopped.
+        Returns the number of samples skipped """
+        return sum(len(self.next_batch()[1]) for _ in range(batches))
+
+    def next_batch(self):
+        """ (bucket_id, sample indices) of the next batch, thread safe """
+        with self._lock:
+            if not self._batches:
+                if self.total_size == 0:
+                    raise ValueError('no training samples fit in BUCKETS')
+                self._shuffle_epoch()
+                self.epoch += 1
+            return self._batches.pop()
+
+class BatchPrefetcher:
+    """ Builds batches on background threads so that the training loop only
+    waits on the model. get() returns whatever batch_fn(rng) returned, train()
+    uses (bucket_id, encoder_inputs, decoder_inputs, decoder_masks, timings)
+    tuples. Every worker thread calls it with its own random.Random """
+    def __init__(self, batch_fn, depth=PREFETCH_DEPTH, workers=PREFETCH_WORKERS, seed=None):
+        self.queue = queue.Queue(maxsize=depth)
+        self.batches = 0
+        # how often (and how long) the consumer had to wait for a batch: input bound
+        self.starved = 0
+        self.starved_time = 0.0
+        # how often a producer found the queue full: compute bound
+        self.full = 0
+        self._stop = threading.Event()
+        self._threads = []
+        for worker in range(workers):
+            rng = random.Random(None if seed is None else seed + worker)
+            thread = threading.Thread(target=self._produce, args=(batch_fn, rng), daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _produce(self, batch_fn, rng):
+        while not self._stop.is_set():
+            try:
+                batch = batch_fn(rng)
+            except Exception as e:
+                # hand the error over to the consumer instead of dying silently
+                batch = e
+            if self.queue.full():
+                self.full += 1
+            while not self._stop.is_set():
+                try:
+                    self.queue.put(batch, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+            if isinstance(batch, Exception):
+                return
+
+    def get(self):
+        try:
+            batch = self.queue.get_nowait()
+        except queue.Empty:
+            self.starved += 1
+            start = time.time()
+            batch = self.queue.get()
+            self.starved_time += time.time() - start
+        if isinstance(batch, Exception):
+            raise batch
+        self.batches += 1
+        return batch
+
+    def stats(self):
+        return ('input queue: {} batches, starved {} times ({:.2f}s waiting), '
+                'producers blocked on a full queue {} times').format(
+                    self.batches, self.starved, self.starved_time, self.full)
+
+    def close(self):
+        self._stop.set()
+        for thread in self._threads:
+            thread.join()
 
 def _assert_lengths(encoder_size, decoder_size, encoder_inputs, decoder_inputs, decoder_masks):
     """ Assert that the encoder inputs, decoder inputs, and decoder masks are
@@ -306,20 +1019,42 @@ def _assert_lengths(encoder_size, decoder_size, encoder_inputs, decoder_inputs,
         raise ValueError("Weights length must be equal to the one in bucket,"
                        " %d != %d." % (len(decoder_masks), decoder_size))
 
-def run_step(sess, model, encoder_inputs, decoder_inputs, decoder_masks, bucket_id, forward_only):
+def _split_batch(encoder_inputs, decoder_inputs, decoder_masks, shards):
+    """ Split a batch into shards along the batch axis. A batch with fewer
+    samples than shards repeats samples so that no shard is empty """
+    if shards == 1:
+        return [(encoder_inputs, decoder_inputs, decoder_masks)]
+    encoder_inputs, decoder_inputs, decoder_masks = map(np.asarray, (encoder_inputs, decoder_inputs, decoder_masks))
+    samples = np.arange(encoder_inputs.shape[1])
+    if len(samples) < shards:
+        samples = np.resize(samples, shards)
+    return [(encoder_inputs[:, part], decoder_inputs[:, part], decoder_masks[:, part])
+            for part in np.array_split(samples, shards)]
+
+def run_step(sess, model, encoder_inputs, decoder_inputs, decoder_masks, bucket_id, forward_only,
+             timings=None, run_metadata=None, loss_only=False):
+    """ One training or forward-only step. A forward-only step with loss_only
+    fetches just the loss, not the outputs. The seconds spent building the
+    feed dict and in sess.run are stored in timings if given, and a full
+    trace of the step in run_metadata if given """
     encoder_size, decoder_size = BUCKETS[bucket_id]
+    model.build_bucket(bucket_id)
+    start = time.time()
     _assert_lengths(encoder_size, decoder_size, encoder_inputs, decoder_inputs, decoder_masks)
 
-    # input feed: encoder inputs, decoder inputs, target_weights, as provided.
+    # input feed: encoder inputs, decoder inputs, target_weights, as provided,
+    # a slice of the batch for every replica.
     input_feed = {}
-    for step in range(encoder_size):
-        input_feed[model.encoder_inputs[step].name] = encoder_inputs[step]
-    for step in range(decoder_size):
-        input_feed[model.decoder_inputs[step].name] = decoder_inputs[step]
-        input_feed[model.decoder_masks[step].name] = decoder_masks[step]
+    for placeholders, batch in zip(model.replica_inputs,
+                                   _split_batch(encoder_inputs, decoder_inputs, decoder_masks, model.replicas)):
+        for step in range(encoder_size):
+            input_feed[placeholders[0][step].name] = batch[0][step]
+        for step in range(decoder_size):
+            input_feed[placeholders[1][step].name] = batch[1][step]
+            input_feed[placeholders[2][step].name] = batch[2][step]
 
-    last_target = model.decoder_inputs[decoder_size].name
-    input_feed[last_target] = np.zeros([model.batch_size], dtype=np.int32)
+        last_target = placeholders[1][decoder_size].name
+        input_feed[last_target] = np.zeros([len(batch[1][0])], dtype=np.int32)
 
     # output feed: depends on whether we do a backward step or not.
     if not forward_only:
@@ -328,14 +1063,20 @@ def run_step(sess, model, encoder_inputs, decoder_inputs, decoder_masks, bucket_
                        model.losses[bucket_id]]  # loss for this batch.
     else:
         output_feed = [model.losses[bucket_id]]  # loss for this batch.
-        for step in range(decoder_size):  # output logits.
+        for step in range(0 if loss_only else decoder_size):  # output logits.
             output_feed.append(model.outputs[bucket_id][step])
 
-    outputs = sess.run(output_feed, input_feed)
+    if timings is not None:
+        timings['feed'] = time.time() - start
+    start = time.time()
+    run_options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE) if run_metadata is not None else None
+    outputs = sess.run(output_feed, input_feed, options=run_options, run_metadata=run_metadata)
+    if timings is not None:
+        timings['run'] = time.time() - start
     if not forward_only:
         return outputs[1], outputs[2], None  # Gradient norm, loss, no outputs.
     else:
-        return None, outputs[0], outputs[1:]  # No gradient norm, loss, outputs.
+        return None, outputs[0], outputs[1:] or None  # No gradient norm, loss, outputs.
 
 
 def _get_buckets():
@@ -344,12 +1085,7 @@ def _get_buckets():
     train_bucket_sizes = [len(data_buckets[b]) for b in range(len(BUCKETS))]
     print("Buckets: "+ str(BUCKETS))
     print("Number of samples in each bucket:\n", train_bucket_sizes)
-    train_total_size = sum(train_bucket_sizes)
-    # list of increasing numbers from 0 to 1 that we'll use to select a bucket.
-    train_buckets_scale = [sum(train_bucket_sizes[:i + 1]) / train_total_size
-                           for i in range(len(train_bucket_sizes))]
-    print("Bucket scale:\n", train_buckets_scale)
-    return test_buckets, data_buckets, train_buckets_scale
+    return test_buckets, data_buckets
 
 
 def _get_user_input():
@@ -363,125 +1099,676 @@ def _find_right_bucket(length):
     return min([b for b in range(len(BUCKETS))
                 if BUCKETS[b][0] >= length])
 
-def _construct_response(output_logits, inv_dec_vocab):
-    outputs = [int(np.argmax(logit, axis=1)) for logit in output_logits]
+def _ids_to_response(outputs, inv_dec_vocab):
     # If there is an EOS symbol in outputs, cut them at that point.
     if EOS_ID in outputs:
         outputs = outputs[:outputs.index(EOS_ID)]
     # Print out sentence corresponding to outputs.
     return " ".join([tf.compat.as_str(inv_dec_vocab[output]) for output in outputs])
 
-def train():
-    """ Train the bot """
-    test_buckets, data_buckets, train_buckets_scale = _get_buckets()
+def _construct_responses(output_logits, inv_dec_vocab):
+    """ Greedy responses for every sentence in a batch of output logits """
+    # [decoder_size, batch_size] -> one row of output ids per sentence
+    batch_outputs = np.argmax(np.stack(output_logits), axis=2).T
+    return [_ids_to_response(outputs, inv_dec_vocab) for outputs in batch_outputs.tolist()]
+
+def _length_penalty(lengths, alpha):
+    """ GNMT length normalization, ((5 + length) / 6) ** alpha """
+    return ((5.0 + lengths) / 6.0) ** alpha
+
+def _encode(sess, model, token_ids_list, bucket_id):
+    """ Run the step-wise encoder once. Returns the attention states and the
+    per-layer initial decoder state """
+    encoder_size = BUCKETS[bucket_id][0]
+    model.build_decoder_step(bucket_id)
+    bucket = _pack_samples([(token_ids, []) for token_ids in token_ids_list], bucket_id)
+    encoder_inputs = bucket.encoder.T
+    return sess.run([model.encoder_attention[bucket_id], model.encoder_state[bucket_id]],
+                    {model.encoder_inputs[step]: encoder_inputs[step] for step in range(encoder_size)})
+
+def _step_feed(model, bucket_id, inputs, state, attention, shortlist_ids=None):
+    input_feed = {model.step_inputs: inputs, model.step_attention[bucket_id]: attention}
+    for placeholder, layer in zip(model.step_state, state):
+        input_feed[placeholder] = layer
+    if shortlist_ids is not None:
+        input_feed[model.shortlist] = shortlist_ids
+    return input_feed
+
+def _greedy_decode(sess, model, token_ids_list, bucket_id, shortlist_ids=None):
+    """ Greedy decoding over the step-wise decoder. The encoder runs once, then
+    every sess.run advances the sentences that have not produced EOS_ID yet
+    by one token, so the cost follows the output length, not the bucket size.
+    With shortlist_ids only those target ids are scored. Returns the output ids
+    of every sentence """
+    decoder_size = BUCKETS[bucket_id][1]
+    attention, state = _encode(sess, model, token_ids_list, bucket_id)
+    outputs = [[] for _ in token_ids_list]
+    # rows of the sentences still decoding
+    alive = np.arange(len(token_ids_list))
+    # see _beam_search for why the first decoder input is PAD_ID
+    inputs = np.full(len(token_ids_list), PAD_ID, dtype=np.int32)
+    steps = model.step_greedy if shortlist_ids is None else model.step_shortlist_greedy
+    for step in range(decoder_size):
+        inputs, state = sess.run(steps[bucket_id][min(step, 1)],
+                                 _step_feed(model, bucket_id, inputs, state, attention, shortlist_ids))
+        for row, output in zip(alive, inputs.tolist()):
+            outputs[row].append(output)
+        # drop the finished sentences from the batch
+        keep = inputs != EOS_ID
+        if not keep.any():
+            break
+        if not keep.all():
+            alive, inputs, attention = alive[keep], inputs[keep], attention[keep]
+            state = [layer[keep] for layer in state]
+    return outputs
+
+def _beam_search(sess, model, token_ids_list, bucket_id, beam_width, length_penalty=LENGTH_PENALTY,
+                 shortlist_ids=None):
+    """ Beam search over the step-wise decoder. The beams of all sentences form
+    one batch of len(token_ids_list) * beam_width rows, so every decoder step
+    is a single sess.run. Stops as soon as every beam has produced EOS_ID.
+    With shortlist_ids only those target ids are scored. Returns the output ids
+    of the best beam of every sentence """
+    decoder_size = BUCKETS[bucket_id][1]
+    batch_size = len(token_ids_list)
+    attention, state = _encode(sess, model, token_ids_list, bucket_id)
+    # row i * beam_width + k holds beam k of sentence i
+    attention = np.repeat(attention, beam_width, axis=0)
+    state = [np.repeat(layer, beam_width, axis=0) for layer in state]
+    # the bucketed graph has always been fed an empty decoder side, so the first
+    # decoder input is PAD_ID. Keep that so beam_width=1 matches greedy decoding.
+    inputs = np.full(batch_size * beam_width, PAD_ID, dtype=np.int32)
+    # only the first beam is alive at the start, the others would be duplicates
+    scores = np.full((batch_size, beam_width), -np.inf)
+    scores[:, 0] = 0.0
+    lengths = np.zeros((batch_size, beam_width))
+    finished = np.zeros((batch_size, beam_width), dtype=bool)
+    history = np.zeros((batch_size, beam_width, 0), dtype=np.int32)
+    rows = np.arange(batch_size)[:, None]
+    steps = model.step_outputs if shortlist_ids is None else model.step_shortlist_outputs
+
+    for step in range(decoder_size):
+        input_feed = _step_feed(model, bucket_id, inputs, state, attention, shortlist_ids)
+        input_feed[model.step_k] = beam_width
+        top_log_probs, top_ids, state = sess.run(steps[bucket_id][min(step, 1)], input_feed)
+        top_log_probs = top_log_probs.reshape(batch_size, beam_width, beam_width)
+        top_ids = top_ids.reshape(batch_size, beam_width, beam_width)
+        # a finished beam carries over once, unchanged
+        top_log_probs[finished] = [0.0] + [-np.inf] * (beam_width - 1)
+        top_ids[finished] = PAD_ID
+
+        candidates = (scores[:, :, None] + top_log_probs).reshape(batch_size, -1)
+        candidate_lengths = np.where(finished, lengths, step + 1)[:, :, None].repeat(beam_width, axis=2)
+        normalized = candidates / _length_penalty(candidate_lengths.reshape(batch_size, -1), length_penalty)
+        best = np.argsort(-normalized, axis=1, kind='stable')[:, :beam_width]
+        parents = best // beam_width
+
+        new_ids = top_ids.reshape(batch_size, -1)[rows, best]
+        scores = candidates[rows, best]
+        lengths = candidate_lengths.reshape(batch_size, -1)[rows, best]
+        finished = finished[rows, parents] | (new_ids == EOS_ID)
+        history = np.concatenate([history[rows, parents], new_ids[:, :, None]], axis=2)
+        reorder = (rows * beam_width + parents).reshape(-1)
+        state = [layer[reorder] for layer in state]
+        inputs = new_ids.reshape(-1).astype(np.int32)
+        if finished.all():
+            break
+
+    best = np.argmax(scores / _length_penalty(lengths, length_penalty), axis=1)
+    return [history[i, best[i]].tolist() for i in range(batch_size)]
+
+class TranslationCache:
+    """ LRU cache of responses keyed on the encoder token ids and the
+    DecodeOptions (as plain tuples, so saved caches do not depend on where
+    DecodeOptions lives), with an optional time to live in seconds. An entry holds
+    at most a bucket worth of ids and words, so max_entries bounds the memory.
+    Hits never touch TensorFlow. model_id (see _model_id) is saved with the
+    entries, and load() ignores files saved for another model """
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES, ttl=None, model_id=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.model_id = model_id
+        self.entries = collections.OrderedDict()  # key -> (response, time stored)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._lock = threading.Lock()
+
+    def get(self, token_ids, options):
+        key = (tuple(token_ids), tuple(options))
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is not None and self.ttl is not None and time.time() - entry[1] > self.ttl:
+                del self.entries[key]
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, token_ids, options, response):
+        with self._lock:
+            key = (tuple(token_ids), tuple(options))
+            self.entries[key] = (response, time.time())
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def save(self, path):
+        with self._lock:
+            entries = list(self.entries.items())
+        with open(path + '.tmp', 'wb') as f:
+            pickle.dump({'model_id': self.model_id, 'entries': entries}, f)
+        os.replace(path + '.tmp', path)
+
+    def load(self, path):
+        """ Warm the cache from a file written by save(), oldest entries first.
+        Returns False, loading nothing, if the file was saved for another model """
+        with open(path, 'rb') as f:
+            saved = pickle.load(f)
+        if not isinstance(saved, dict) or saved['model_id'] != self.model_id:
+            return False
+        with self._lock:
+            for key, entry in saved['entries'][-self.max_entries:]:
+                self.entries[key] = entry
+        return True
+
+    def stats(self):
+        return {'entries': len(self.entries), 'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'expirations': self.expirations}
+
+
+def _make_shortlist(options, enc_vocab, dec_vocab):
+    """ The Shortlist options.shortlist asks for, or None """
+    if not options.shortlist:
+        return None
+    start = time.time()
+    shortlist = Shortlist(enc_vocab, dec_vocab)
+    print('Loaded {} lexicon entries in {:.2f}s'.format(len(shortlist.translations), time.time() - start))
+    return shortlist
+
+def _model_id(frozen=None):
+    """ Identifies the weights _inference_session(frozen=frozen) decodes with:
+    the path and modification time of the frozen graph or of the
+    _decode_checkpoint(). None if there is neither """
+    path = frozen or _decode_checkpoint()
+    if not path:
+        return None
+    return path, os.path.getmtime(path if frozen else path + '.index')
+
+def _make_cache(max_entries, ttl=None, path=None, model_id=None):
+    """ A TranslationCache for the model model_id, warmed from path if it
+    exists and was saved for the same model. None if max_entries is 0 """
+    if not max_entries:
+        return None
+    cache = TranslationCache(max_entries, ttl, model_id)
+    if path and os.path.exists(path):
+        if cache.load(path):
+            print('Loaded {} cached translations from {}'.format(len(cache.entries), path))
+        else:
+            print('Ignoring {}, it was saved for another model'.format(path))
+    return cache
+
+
+def _translate_batch(sess, model, token_ids_list, inv_dec_vocab, options=DecodeOptions(), cache=None,
+                     shortlist=None):
+    """ Translate a list of encoder token ids. Sentences are grouped by bucket
+    and decoded model.batch_size at a time, greedily or with beam search
+    according to options. With options.shortlist every chunk only scores the
+    candidates shortlist gives for it. Sentences found in cache are not
+    decoded at all. Responses are returned in the input order """
+    if options.shortlist and (shortlist is None or (options.beam_width == 1 and not options.incremental)):
+        raise ValueError('shortlist decoding needs a Shortlist and the step-wise decoder')
+    responses = [None] * len(token_ids_list)
+    bucket_members = [[] for _ in BUCKETS]
+    for i, token_ids in enumerate(token_ids_list):
+        if cache is not None:
+            responses[i] = cache.get(token_ids, options)
+            if responses[i] is not None:
+                continue
+        bucket_members[_find_right_bucket(len(token_ids))].append(i)
+
+    for bucket_id, members in enumerate(bucket_members):
+        for start in range(0, len(members), model.batch_size):
+            chunk = members[start:start + model.batch_size]
+            shortlist_ids = shortlist.candidates([token_ids_list[i] for i in chunk]) if options.shortlist else None
+            if options.beam_width > 1:
+                outputs = _beam_search(sess, model, [token_ids_list[i] for i in chunk], bucket_id,
+                                       options.beam_width, options.length_penalty, shortlist_ids)
+                chunk_responses = [_ids_to_response(ids, inv_dec_vocab) for ids in outputs]
+            elif options.incremental:
+                outputs = _greedy_decode(sess, model, [token_ids_list[i] for i in chunk], bucket_id, shortlist_ids)
+                chunk_responses = [_ids_to_response(ids, inv_dec_vocab) for ids in outputs]
+            else:
+                samples = [(token_ids_list[i], []) for i in chunk]
+                # pad the last partial batch with empty sentences, their outputs are dropped below
+                samples += [([], [])] * (model.batch_size - len(chunk))
+                encoder_inputs, decoder_inputs, decoder_masks = _make_batch(
+                    _pack_samples(samples, bucket_id), np.arange(model.batch_size), bucket_id)
+                _, _, output_logits = run_step(sess, model, encoder_inputs, decoder_inputs,
+                                               decoder_masks, bucket_id, True)
+                chunk_responses = _construct_responses(output_logits, inv_dec_vocab)
+            for i, response in zip(chunk, chunk_responses):
+                responses[i] = response
+                if cache is not None:
+                    cache.put(token_ids_list[i], options, response)
+    return responses
+
+def _inference_session(batch_size, lazy=LAZY_BUILD, frozen=None):
+    """ (model, session) to decode with: the graph saved by export() if frozen
+    is given, else the model built in Python with the checkpoint restored """
+    if frozen:
+        model = FrozenModel(frozen, batch_size)
+        return model, tf.Session(graph=model.graph)
+    model = ChatBotModel(True, batch_size=batch_size, lazy=lazy)
+    model.build_graph()
+    saver = tf.train.Saver()
+    checkpoint = _decode_checkpoint()
+    if not checkpoint:
+        raise ValueError('no checkpoint in {}, train first'.format(CPT_PATH))
+    sess = tf.Session()
+    # restore sets every variable, there is nothing left to initialize
+    saver.restore(sess, checkpoint)
+    return model, sess
+
+def _half_weights(graph_def):
+    """ Store proj_w and the embeddings as float16 constants that are cast back
+    to float32 when the graph runs """
+    half_graph_def = tf.GraphDef()
+    half_graph_def.versions.CopyFrom(graph_def.versions)
+    half_graph_def.library.CopyFrom(graph_def.library)
+    for node in graph_def.node:
+        if node.op != 'Const' or node.attr['dtype'].type != tf.float32.as_datatype_enum or \
+                not _HALF_WEIGHTS_RE.match(node.name):
+            half_graph_def.node.add().CopyFrom(node)
+            continue
+        value = tf.make_ndarray(node.attr['value'].tensor).astype(np.float16)
+        half = half_graph_def.node.add()
+        half.op, half.name = 'Const', node.name + '/half'
+        half.device = node.device
+        half.attr['dtype'].type = tf.float16.as_datatype_enum
+        half.attr['value'].tensor.CopyFrom(tf.make_tensor_proto(value))
+        # the cast takes the name of the constant, so its consumers are unchanged
+        cast = half_graph_def.node.add()
+        cast.op, cast.name = 'Cast', node.name
+        cast.device = node.device
+        cast.input.append(half.name)
+        cast.attr['SrcT'].type = tf.float16.as_datatype_enum
+        cast.attr['DstT'].type = tf.float32.as_datatype_enum
+        print('Stored {} {} as float16'.format(node.name, list(value.shape)))
+    return half_graph_def
+
+def export(path=FROZEN_PATH, fp16=False):
+    """ Freeze the step-wise decoders of every bucket with the trained weights
+    into a single pruned and constant-folded GraphDef that FrozenModel loads.
+    The tensors FrozenModel needs are listed in a JSON manifest next to it """
+    model, sess = _inference_session(DECODE_BATCH_SIZE, lazy=False)
+    with sess:
+        tensors = {attribute: _tensor_names(getattr(model, attribute)) for attribute in FrozenModel.ATTRIBUTES}
+        names = list(_flatten_names(tensors.values()))
+        nodes = {name.split(':')[0] for name in names}
+        inputs = sorted(node for node in nodes if sess.graph.get_operation_by_name(node).type == 'Placeholder')
+        outputs = sorted(nodes - set(inputs))
+        # only the nodes the outputs depend on are kept, training state is dropped
+        graph_def = tf.graph_util.convert_variables_to_constants(sess, sess.graph.as_graph_def(), outputs)
+    graph_def = TransformGraph(graph_def, inputs, outputs,
+                               ['remove_device', 'fold_constants(ignore_errors=true)', 'sort_by_execution_order'])
+    if fp16:
+        graph_def = _half_weights(graph_def)
+    with open(path, 'wb') as f:
+        f.write(graph_def.SerializeToString())
+    with open(_manifest_path(path), 'w') as f:
+        json.dump({'buckets': BUCKETS, 'tensors': tensors}, f)
+    checkpoint_dir, checkpoint = os.path.split(_decode_checkpoint())
+    checkpoint_size = sum(os.path.getsize(os.path.join(checkpoint_dir, filename))
+                          for filename in os.listdir(checkpoint_dir) if filename.startswith(checkpoint + '.'))
+    print('Exported {} nodes to {}: {:.1f} MB, the checkpoint is {:.1f} MB'.format(
+        len(graph_def.node), path, os.path.getsize(path) / 2 ** 20, checkpoint_size / 2 ** 20))
+
+def _flatten_names(names):
+    for name in names:
+        if isinstance(name, list):
+            yield from _flatten_names(name)
+        else:
+            yield name
+
+class TrainingMetrics:
+    """ Per-step training metrics written as JSON lines to path: the seconds the
+    prefetch thread spent sampling and building the batch, and the seconds
+    the training loop spent waiting for it, building the feed dict and in
+    sess.run, plus tokens/sec, padding ratio and steps per bucket.
+    summary() aggregates the steps since the previous summary """
+    def __init__(self, path=None):
+        self.file = open(path, 'a') if path else None
+        self.bucket_steps = collections.Counter()
+        self._reset()
+
+    def _reset(self):
+        self._steps = 0
+        self._seconds = collections.Counter()
+        self._tokens = self._padded = 0
+
+    def record_validation(self, iteration, loss, bucket_losses):
+        if self.file:
+            self.file.write(json.dumps({'step': int(iteration), 'validation_loss': loss,
+                                        'bucket_losses': bucket_losses}) + '\n')
+            self.file.flush()
+
+    def record(self, iteration, bucket_id, loss, encoder_inputs, decoder_inputs, timings):
+        tokens = int(np.count_nonzero(encoder_inputs != PAD_ID) + np.count_nonzero(decoder_inputs != PAD_ID))
+        padded = encoder_inputs.size + decoder_inputs.size
+        self.bucket_steps[bucket_id] += 1
+        self._steps += 1
+        self._seconds.update(timings)
+        self._tokens += tokens
+        self._padded += padded
+        if self.file:
+            self.file.write(json.dumps({
+                'step': int(iteration), 'bucket': bucket_id, 'loss': float(loss),
+                'batch_size': int(encoder_inputs.shape[1]), 'tokens': tokens,
+                'padding': round(1 - tokens / padded, 4),
+                'tokens_per_sec': round(tokens / timings['step'], 1),
+                'seconds': {stage: round(seconds, 6) for stage, seconds in timings.items()}}) + '\n')
+
+    def summary(self):
+        summary = {'steps': self._steps,
+                   'ms_per_step': {stage: round(seconds / max(self._steps, 1) * 1000, 2)
+                                   for stage, seconds in self._seconds.items()},
+                   'tokens_per_sec': round(self._tokens / self._seconds['step'], 1) if self._seconds['step'] else 0,
+                   'padding': round(1 - self._tokens / self._padded, 4) if self._padded else 0,
+                   'bucket_steps': {bucket_id: self.bucket_steps[bucket_id]
+                                    for bucket_id in sorted(self.bucket_steps)}}
+        if self.file:
+            self.file.flush()
+        self._reset()
+        return summary
+
+    def close(self):
+        if self.file:
+            self.file.close()
+
+def _write_trace(run_metadata, iteration):
+    """ Save the trace of a step for chrome://tracing """
+    path = os.path.join(CPT_PATH, 'timeline_{}.json'.format(iteration))
+    with open(path, 'w') as f:
+        f.write(timeline.Timeline(run_metadata.step_stats).generate_chrome_trace_format())
+    print('Saved the trace of step {} to {}'.format(iteration, path))
+
+class AsyncCheckpointer:
+    """ Saves checkpoints on a background thread while training goes on.
+    save() first copies every variable into a snapshot variable, a quick
+    in-graph copy, so each checkpoint holds the values of a single step. The
+    snapshots are saved under the names of the variables they copy, and
+    the last max_to_keep checkpoints are kept. save(best=True) saves to
+    best_prefix instead, where only the last one is kept """
+    def __init__(self, prefix=CHECKPOINT_PREFIX, max_to_keep=KEEP_CHECKPOINTS, best_prefix=BEST_CHECKPOINT_PREFIX):
+        variables = tf.global_variables()
+        with tf.name_scope('checkpoint_snapshot'):
+            # in no collection: they are never initialized, restored or trained
+            snapshots = [tf.Variable(tf.zeros(variable.shape, variable.dtype.base_dtype), trainable=False,
+                                     collections=[], name=variable.op.name.replace('/', '_'))
+                         for variable in variables]
+            self._copy = tf.group(*[tf.assign(snapshot, variable)
+                                    for snapshot, variable in zip(snapshots, variables)])
+        var_list = {variable.op.name: snapshot for variable, snapshot in zip(variables, snapshots)}
+        self.saver = tf.train.Saver(var_list, max_to_keep=max_to_keep)
+        self.best_saver = tf.train.Saver(var_list, max_to_keep=1)
+        self.prefix = prefix
+        self.best_prefix = best_prefix
+        self.last_step = None
+        self._thread = None
+        self._error = None
+
+    def recover(self, step):
+        """ Take over the checkpoints of the run resumed at step, which a new
+        Saver does not know about, so the oldest of them are still deleted """
+        for saver, prefix in [(self.saver, self.prefix), (self.best_saver, self.best_prefix)]:
+            state = tf.train.get_checkpoint_state(os.path.dirname(prefix))
+            if state is not None:
+                saver.recover_last_checkpoints(state.all_model_checkpoint_paths)
+        self.last_step = step
+
+    def save(self, sess, step, wait=False, best=False):
+        self.wait()
+        sess.run(self._copy)
+        saver, prefix = (self.best_saver, self.best_prefix) if best else (self.saver, self.prefix)
+        if not best:
+            self.last_step = step
+        self._thread = threading.Thread(target=self._save, args=(sess, step, saver, prefix), daemon=True)
+        self._thread.start()
+        if wait:
+            self.wait()
+
+    def _save(self, sess, step, saver, prefix):
+        start = time.time()
+        try:
+            os.makedirs(os.path.dirname(prefix), exist_ok=True)
+            path = saver.save(sess, prefix, global_step=step)
+            print('Saved {} in {:.1f}s'.format(path, time.time() - start))
+        except Exception as e:
+            self._error = e
+
+    def wait(self):
+        """ Wait for the checkpoint being written, raising its error if it failed """
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+def _latest_checkpoint():
+    return tf.train.latest_checkpoint(CPT_PATH)
+
+def _decode_checkpoint():
+    """ The checkpoint to decode and export with: the one with the lowest
+    validation loss if training saved one, else the latest """
+    return tf.train.latest_checkpoint(os.path.dirname(BEST_CHECKPOINT_PREFIX)) or _latest_checkpoint()
+
+def _check_restore_parameters(sess, saver):
+    """ Restore the previously trained parameters if there are any """
+    checkpoint = _latest_checkpoint()
+    if checkpoint:
+        print('Loading parameters from ' + checkpoint)
+        saver.restore(sess, checkpoint)
+        return True
+    print('Initializing fresh parameters')
+    return False
+
+def _validation_batches(test_buckets, seed=SAMPLER_SEED):
+    """ A fixed sample of at most BATCH_SIZE pairs of every test bucket, so that
+    validation losses are comparable across steps """
+    rng = random.Random(seed)
+    return [(bucket_id,) + _make_batch(bucket, sorted(rng.sample(range(len(bucket)), min(len(bucket), BATCH_SIZE))),
+                                       bucket_id)
+            for bucket_id, bucket in enumerate(test_buckets) if len(bucket)]
+
+def _validation_loss(sess, model, batches):
+    """ Forward-only loss over the validation batches, averaged by batch size.
+    It is the sampled softmax loss of training, so it carries some noise """
+    losses, sizes = [], []
+    for bucket_id, encoder_inputs, decoder_inputs, decoder_masks in batches:
+        _, loss, _ = run_step(sess, model, encoder_inputs, decoder_inputs, decoder_masks, bucket_id, True,
+                              loss_only=True)
+        losses.append(loss)
+        sizes.append(len(decoder_masks[0]))
+    return float(np.average(losses, weights=sizes)), {batch[0]: float(loss) for batch, loss in zip(batches, losses)}
+
+def _load_validations(iteration):
+    """ The [step, loss] validations saved by a previous run, up to the
+    checkpoint at iteration that training resumes from """
+    if not os.path.exists(VALIDATION_PATH):
+        return []
+    with open(VALIDATION_PATH) as f:
+        return [[step, loss] for step, loss in json.load(f) if step <= iteration]
+
+def _save_validations(validations):
+    with open(VALIDATION_PATH + '.tmp', 'w') as f:
+        json.dump(validations, f)
+    os.replace(VALIDATION_PATH + '.tmp', VALIDATION_PATH)
+
+def _early_stopping_state(validations, start_step):
+    """ (best loss, its step, validations since then without a lower loss) """
+    best_loss, best_step, bad_validations = np.inf, start_step, 0
+    for step, loss in validations:
+        if loss < best_loss:
+            best_loss, best_step, bad_validations = loss, step, 0
+        else:
+            bad_validations += 1
+    return best_loss, best_step, bad_validations
+
+def train(token_budget=TOKEN_BUDGET, seed=SAMPLER_SEED, metrics_path=METRICS_PATH, trace_steps=(),
+          patience=EARLY_STOP_PATIENCE, replicas=REPLICAS):
+    """ Train the bot, resuming from the latest checkpoint if there is one.
+    With replicas > 1 every step trains replicas batches of the same bucket
+    in parallel, one per replica, and averages their gradients.
+    A checkpoint is saved every CHECKPOINT_STEPS steps and the validation
+    loss on test_buckets is computed every VALIDATE_STEPS steps. Training
+    stops early after patience validations without improvement, counting
+    the validations of the run it resumes (saved to VALIDATION_PATH). Every
+    new lowest validation loss is also saved to BEST_CHECKPOINT_PREFIX, the
+    checkpoint test, translate, serve and export then use. Per-step
+    metrics go to metrics_path as JSON lines, and the steps in trace_steps
+    are traced for chrome://tracing """
+    test_buckets, data_buckets = _get_buckets()
     # in train mode, we need to create the backward path, so forwrad_only is False
-    model = ChatBotModel(False, BATCH_SIZE)
+    model = ChatBotModel(False, BATCH_SIZE, replicas=replicas)
     model.build_graph()
 
     saver = tf.train.Saver()
+    checkpointer = AsyncCheckpointer()
+    validation_batches = _validation_batches(test_buckets, seed)
 
-    with tf.Session() as sess:
+    # a step takes the batches of all replicas from the same bucket
+    sampler = EpochSampler([len(bucket) for bucket in data_buckets], BATCH_SIZE * replicas,
+                           token_budget and token_budget * replicas, seed)
+    print("Batch size of each bucket:\n", sampler.batch_sizes)
+
+    def sample_batch(rng):
+        start = time.time()
+        bucket_id, indices = sampler.next_batch()
+        sampled = time.time()
+        batch = _make_batch(data_buckets[bucket_id], indices, bucket_id)
+        return (bucket_id,) + batch + ({'sample': sampled - start, 'build': time.time() - sampled},)
+
+    metrics = TrainingMetrics(metrics_path)
+    with tf.Session(config=_session_config(replicas)) as sess:
         sess.run(tf.global_variables_initializer())
-        #_check_restore_parameters(sess, saver)
-        #saver.restore(sess, saver)
+        resumed = _check_restore_parameters(sess, saver)
         iteration = model.global_step.eval()
+        if resumed:
+            checkpointer.recover(iteration)
         total_loss = 0
-        while iteration <= MAX_ITERATION:
-            skip_step = 2000
-            bucket_id = _get_random_bucket(train_buckets_scale)
-            encoder_inputs, decoder_inputs, decoder_masks = get_batch(data_buckets[bucket_id], bucket_id, batch_size=BATCH_SIZE)
-            start = time.time()
-            _, step_loss, _ = run_step(sess, model, encoder_inputs, decoder_inputs, decoder_masks, bucket_id, False)
-            total_loss += step_loss
-            if iteration == 0:
-                print('Iter {}: loss {}'.format(iteration, total_loss))
-                total_loss = 0
-            iteration += 1
-            if iteration % skip_step == 0:
-                print('Iter {}: loss {}'.format(iteration, total_loss/skip_step))
-                total_loss = 0
-                sys.stdout.flush()
-        save_path = saver.save(sess, "./model/model.ckpt")
-        print("Model saved in file: "+save_path)
-
-def splitstrings(orig,mode):
-    split_strings_list=[]
-    if mode ==1:
-        for a in orig:
-            split_strings_list=split_strings_list + [a[0].split()]
-        return split_strings_list
-    else:
-        for a in orig:
-            split_strings_list=split_strings_list + [[a[0].split()]]
-        return split_strings_list
-
-def test():
+        # carry on with the batches of the epoch the previous run stopped in
+        samples_seen = sampler.skip(iteration)
+        validations = _load_validations(iteration)
+        best_loss, best_step, bad_validations = _early_stopping_state(validations, iteration)
+        prefetcher = BatchPrefetcher(sample_batch)
+        try:
+            while iteration <= MAX_ITERATION:
+                skip_step = 2000
+                start = time.time()
+                bucket_id, encoder_inputs, decoder_inputs, decoder_masks, timings = prefetcher.get()
+                timings['wait'] = time.time() - start
+                run_metadata = tf.RunMetadata() if iteration in trace_steps else None
+                _, step_loss, _ = run_step(sess, model, encoder_inputs, decoder_inputs, decoder_masks, bucket_id, False,
+                                           timings, run_metadata)
+                timings['step'] = time.time() - start
+                metrics.record(iteration, bucket_id, step_loss, encoder_inputs, decoder_inputs, timings)
+                if run_metadata is not None:
+                    _write_trace(run_metadata, iteration)
+                total_loss += step_loss
+                samples_seen += len(decoder_masks[0])
+                if iteration == 0:
+                    print('Iter {}: loss {}'.format(iteration, total_loss))
+                    total_loss = 0
+                iteration += 1
+                if iteration % skip_step == 0:
+                    print('Iter {} (epoch {:.2f}): loss {}'.format(iteration, samples_seen / sampler.total_size,
+                                                                  total_loss/skip_step))
+                    print(prefetcher.stats())
+                    print(json.dumps(metrics.summary()))
+                    total_loss = 0
+                    sys.stdout.flush()
+                if iteration % CHECKPOINT_STEPS == 0:
+                    checkpointer.save(sess, iteration)
+                if iteration % VALIDATE_STEPS == 0 and validation_batches:
+                    loss, bucket_losses = _validation_loss(sess, model, validation_batches)
+                    metrics.record_validation(iteration, loss, bucket_losses)
+                    validations.append([iteration, loss])
+                    _save_validations(validations)
+                    best_loss, best_step, bad_validations = _early_stopping_state(validations, iteration)
+                    if best_step == iteration:
+                        checkpointer.save(sess, iteration, best=True)
+                    print('Iter {}: validation loss {} (best {} at iter {})'.format(iteration, loss, best_loss,
+                                                                                    best_step))
+                    if patience and bad_validations >= patience:
+                        print('No better validation loss in {} validations, stopping'.format(bad_validations))
+                        break
+        finally:
+            prefetcher.close()
+            metrics.close()
+            checkpointer.wait()
+        if checkpointer.last_step != iteration:
+            checkpointer.save(sess, iteration, wait=True)
+        if np.isfinite(best_loss):
+            print('Lowest validation loss {} at iter {}, decoding uses {}'.format(best_loss, best_step,
+                                                                               _decode_checkpoint()))
+
+def test(options=DecodeOptions(), lazy=LAZY_BUILD, frozen=None):
     _, enc_vocab = load_vocab(os.path.join(PROCESSED_PATH, 'vocab.en'))
-    inv_dec_vocab, _ = load_vocab(os.path.join(PROCESSED_PATH, 'vocab.vi'))
+    inv_dec_vocab, dec_vocab = load_vocab(os.path.join(PROCESSED_PATH, 'vocab.vi'))
+    shortlist = _make_shortlist(options, enc_vocab, dec_vocab)
 
-    model = ChatBotModel(True, batch_size=1)
-    model.build_graph()
+    model, sess = _inference_session(DECODE_BATCH_SIZE, lazy, frozen)
     totallines = []
     filtered=[]
     responses = []
     originals=[]
-    saver = tf.train.Saver()
-    with tf.Session() as sess:
-        sess.run(tf.global_variables_initializer())
-        saver.restore(sess,"model/model.ckpt")
+    with sess:
         # Decode from standard input.
         max_length = BUCKETS[-1][0]
         f1 = open(os.path.join(PROCESSED_PATH, 'tst2012.en'), 'r')
         f2 = open(os.path.join(PROCESSED_PATH, 'tst2012.vi'), 'r')
 
         for line in f1:
-            line=line.replace('\n','')
-            totallines = totallines + [[line]]
-        #print(len(totallines))
+            totallines.append([line.replace('\n', '')])
         for orig in f2:
-            orig=orig.replace('\n', '')
-            originals = originals + [[orig]]
-        #print(len(originals))
+            originals.append(orig.replace('\n', ''))
+        batch_token_ids = []
         for i in range(0,len(totallines)):
             line=totallines[i]
             token_ids = sentence2id(enc_vocab, str(line))
             if (len(token_ids) > max_length):
                 continue
-            filtered=filtered+[originals[i]]
-            # Which bucket does it belong to?
-            bucket_id = _find_right_bucket(len(token_ids))
-            # Get a 1-element batch to feed the sentence to the model.
-            encoder_inputs, decoder_inputs, decoder_masks = get_batch([(token_ids, [])],bucket_id,batch_size=1)
-            # Get output logits for the sentence.
-            _, _, output_logits = run_step(sess, model, encoder_inputs, decoder_inputs,
-                                           decoder_masks, bucket_id, True)
-            response = _construct_response(output_logits, inv_dec_vocab)
-            #print(len(responses))
-            responses.extend([[response]])
-
-        filtered=splitstrings(filtered,1)
-        responses=splitstrings(responses,2)
-        totalscore=0
-        #print(responses)
-        #print(len(responses),len(filtered))
-
-        for i in range(0, len(filtered)):
-            #print(filtered[i])
-            print(' '.join(word for word in responses[i][0]))
-            totalscore = totalscore+sentence_bleu(responses[i][0], filtered[i],smoothing_function=SmoothingFunction().method1)  # ,smoothing_function=sf)
-        print('Average BELU Score: ' + str(totalscore/len(filtered)))
-
-
-def translate():
+            filtered.append(originals[i].split())
+            batch_token_ids.append(token_ids)
+        # Decode all the kept sentences, a full batch per run_step.
+        for response in _translate_batch(sess, model, batch_token_ids, inv_dec_vocab, options,
+                                         shortlist=shortlist):
+            responses.append(response.split())
+
+        for response in responses:
+            print(' '.join(response))
+        # n-grams are counted once per pair, the sentence and corpus scores share them
+        stats = bleu.corpus_stats(filtered, responses, workers=EVAL_WORKERS)
+        scores = bleu.sentence_scores(stats, smoothing=True)
+        print('Average BELU Score: ' + str(sum(scores) / len(scores)))
+        print('Corpus BLEU Score: ' + str(bleu.corpus_bleu(stats)))
+
+
+def translate(options=DecodeOptions(), cache=None, cache_file=None, lazy=LAZY_BUILD, frozen=None):
     _, enc_vocab = load_vocab(os.path.join(PROCESSED_PATH, 'vocab.en'))
-    inv_dec_vocab, _ = load_vocab(os.path.join(PROCESSED_PATH, 'vocab.vi'))
-    model = ChatBotModel(True, batch_size=1)
-    model.build_graph()
-    saver = tf.train.Saver()
+    inv_dec_vocab, dec_vocab = load_vocab(os.path.join(PROCESSED_PATH, 'vocab.vi'))
+    shortlist = _make_shortlist(options, enc_vocab, dec_vocab)
+    model, sess = _inference_session(1, lazy, frozen)
 
-    with tf.Session() as sess:
-        sess.run(tf.global_variables_initializer())
-        saver.restore(sess, "model/model.ckpt")
+    with sess:
         # Decode from standard input.
         max_length = BUCKETS[-1][0]
         while True:
@@ -495,30 +1782,396 @@ def translate():
             if (len(token_ids) > max_length):
                 line = _get_user_input()
                 continue
-            # Which bucket does it belong to?
-            bucket_id = _find_right_bucket(len(token_ids))
-            # Get a 1-element batch to feed the sentence to the model.
-            encoder_inputs, decoder_inputs, decoder_masks = get_batch([(token_ids, [])],bucket_id, batch_size=1)
-            # Get output logits for the sentence.
-            _, _, output_logits = run_step(sess, model, encoder_inputs, decoder_inputs,
-                                           decoder_masks, bucket_id, True)
-            response = _construct_response(output_logits, inv_dec_vocab)
+            response = _translate_batch(sess, model, [token_ids], inv_dec_vocab, options, cache, shortlist)[0]
             print(response)
+        if cache is not None:
+            print('Cache: ' + json.dumps(cache.stats()))
+            if cache_file:
+                cache.save(cache_file)
+
+def _open_text(path, mode):
+    """ open(path), or stdin/stdout for - """
+    if path == '-':
+        return contextlib.nullcontext(sys.stdin if mode == 'r' else sys.stdout)
+    return open(path, mode)
+
+def detokenize(response):
+    """ Undo the spaces basic_tokenizer puts around punctuation """
+    return _DETOKENIZE_RE.sub('', response)
+
+def _read_stage(path, enc_vocab, max_length, out_queue):
+    """ Put (index, line, token_ids) for every line of path on out_queue, with
+    token_ids None for empty and over-length lines, then None. An error is
+    handed over to the consumer instead """
+    try:
+        with _open_text(path, 'r') as f:
+            for index, line in enumerate(f):
+                line = line.rstrip('\n')
+                token_ids = sentence2id(enc_vocab, line)
+                out_queue.put((index, line, token_ids if 0 < len(token_ids) <= max_length else None))
+        out_queue.put(None)
+    except Exception as e:
+        out_queue.put(e)
+
+def _write_stage(path, in_queue, state):
+    """ Write the (index, text, translated) items of in_queue to path in index
+    order until None arrives, detokenizing the translated ones. Items that
+    arrive early wait in a reorder buffer. On error the queue is still drained
+    so the producer never blocks, and the error is left in state """
+    state['written'] = 0
+    try:
+        reorder = {}
+        with _open_text(path, 'w') as f:
+            while True:
+                item = in_queue.get()
+                if item is None:
+                    return
+                index, text, translated = item
+                reorder[index] = detokenize(text) if translated else text
+                while state['written'] in reorder:
+                    f.write(reorder.pop(state['written']) + '\n')
+                    state['written'] += 1
+    except Exception as e:
+        state['error'] = e
+        while in_queue.get() is not None:
+            pass
+
+def translate_file(input_path='-', output_path='-', options=DecodeOptions(), cache=None, lazy=LAZY_BUILD,
+                   frozen=None):
+    """ Translate a file line by line, - for stdin/stdout. Reading and
+    tokenizing, decoding and detokenizing/writing are stages connected by
+    bounded queues, so memory does not grow with the input. Lines are decoded
+    a full batch per bucket at a time and written in input order; empty and
+    over-length lines are written unchanged. Progress goes to stderr """
+    _, enc_vocab = load_vocab(os.path.join(PROCESSED_PATH, 'vocab.en'))
+    inv_dec_vocab, dec_vocab = load_vocab(os.path.join(PROCESSED_PATH, 'vocab.vi'))
+    shortlist = _make_shortlist(options, enc_vocab, dec_vocab)
+    model, sess = _inference_session(DECODE_BATCH_SIZE, lazy, frozen)
+
+    tokenized, decoded = queue.Queue(TRANSLATE_FILE_QUEUE), queue.Queue(TRANSLATE_FILE_QUEUE)
+    writer_state = {}
+    reader = threading.Thread(target=_read_stage, args=(input_path, enc_vocab, BUCKETS[-1][0], tokenized),
+                              daemon=True)
+    writer = threading.Thread(target=_write_stage, args=(output_path, decoded, writer_state), daemon=True)
+    # (index, token_ids) of the lines waiting for their bucket to fill
+    pending = [collections.deque() for _ in BUCKETS]
+    lines = passed = 0
+
+    def decode(bucket_id):
+        chunk = [pending[bucket_id].popleft() for _ in range(min(len(pending[bucket_id]), model.batch_size))]
+        responses = _translate_batch(sess, model, [token_ids for _, token_ids in chunk], inv_dec_vocab, options,
+                                     cache, shortlist)
+        for (index, _), response in zip(chunk, responses):
+            decoded.put((index, response, True))
+
+    start = time.time()
+    with sess:
+        reader.start()
+        writer.start()
+        try:
+            # a failed writer only drains the queue, so stop decoding at once
+            while 'error' not in writer_state:
+                item = tokenized.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                index, line, token_ids = item
+                lines += 1
+                if lines % 10000 == 0:
+                    print('{} lines, {:.1f} lines/sec'.format(lines, lines / (time.time() - start)),
+                          file=sys.stderr)
+                if token_ids is None:
+                    decoded.put((index, line, False))
+                    passed += 1
+                    continue
+                bucket_id = _find_right_bucket(len(token_ids))
+                pending[bucket_id].append((index, token_ids))
+                if len(pending[bucket_id]) == model.batch_size:
+                    decode(bucket_id)
+                # the writer holds everything after the oldest pending line, so a bucket
+                # that fills slowly is decoded early rather than letting that grow
+                oldest_index, oldest_bucket = min([(waiting[0][0], waiting_bucket)
+                                                   for waiting_bucket, waiting in enumerate(pending) if waiting],
+                                                  default=(index, None))
+                if index - oldest_index >= TRANSLATE_FILE_WINDOW:
+                    decode(oldest_bucket)
+            for bucket_id in range(len(BUCKETS)):
+                while pending[bucket_id] and 'error' not in writer_state:
+                    decode(bucket_id)
+        finally:
+            # flush whatever is in order, also when decoding failed
+            decoded.put(None)
+            writer.join()
+    if 'error' in writer_state:
+        raise writer_state['error']
+    elapsed = time.time() - start
+    print('Translated {} lines ({} passed through unchanged) in {:.1f}s, {:.1f} lines/sec'.format(
+        lines, passed, elapsed, lines / elapsed if elapsed else 0), file=sys.stderr)
+
+class MicroBatcher:
+    """ Queues concurrent translation requests per bucket and decodes them in
+    micro-batches of up to batch_size sentences. A bucket is flushed once it
+    is full or its oldest request has waited max_wait seconds. decode_fn runs
+    on a single worker thread, the one that uses the tf.Session """
+    def __init__(self, decode_fn, batch_size, max_wait):
+        self.decode_fn = decode_fn
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.pending = [[] for _ in BUCKETS]  # (token_ids, future, arrival time)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.wakeup = asyncio.Event()
+        self.latencies = collections.deque(maxlen=10000)
+        self.batch_sizes = collections.Counter()
+
+    async def translate(self, token_ids):
+        """ Returns (response, latency in seconds) """
+        arrival = time.time()
+        future = asyncio.get_running_loop().create_future()
+        self.pending[_find_right_bucket(len(token_ids))].append((token_ids, future, arrival))
+        self.wakeup.set()
+        response = await future
+        latency = time.time() - arrival
+        self.latencies.append(latency)
+        return response, latency
+
+    def _ready_buckets(self, now):
+        return [bucket_id for bucket_id, pending in enumerate(self.pending)
+                if len(pending) >= self.batch_size or (pending and now - pending[0][2] >= self.max_wait)]
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            now = time.time()
+            ready = self._ready_buckets(now)
+            if not ready:
+                deadlines = [pending[0][2] + self.max_wait - now for pending in self.pending if pending]
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), min(deadlines) if deadlines else None)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            for bucket_id in ready:
+                batch = self.pending[bucket_id][:self.batch_size]
+                del self.pending[bucket_id][:self.batch_size]
+                self.batch_sizes[len(batch)] += 1
+                # a failed batch fails its requests only, the loop carries on
+                try:
+                    responses = await loop.run_in_executor(self.executor, self.decode_fn,
+                                                           [token_ids for token_ids, _, _ in batch])
+                    error = None
+                except Exception as e:
+                    responses, error = [None] * len(batch), e
+                for (_, future, _), response in zip(batch, responses):
+                    # done if its client has gone away and cancelled it
+                    if future.done():
+                        continue
+                    if error is None:
+                        future.set_result(response)
+                    else:
+                        future.set_exception(error)
+
+    def stats(self):
+        latencies = np.array(self.latencies) * 1000
+        batches = sum(self.batch_sizes.values())
+        sentences = sum(size * count for size, count in self.batch_sizes.items())
+        stats = {'requests': sentences, 'batches': batches,
+                 'mean_batch_fill': sentences / batches / self.batch_size if batches else 0.0,
+                 'batch_sizes': {str(size): count for size, count in sorted(self.batch_sizes.items())}}
+        if len(latencies):
+            for percentile in [50, 90, 99]:
+                stats['p{}_latency_ms'.format(percentile)] = float(np.percentile(latencies, percentile))
+        return stats
+
+
+async def _read_http_request(reader):
+    """ Returns (method, path, body) of one HTTP/1.x request """
+    method, path, _ = (await reader.readline()).decode('latin-1').split(' ', 2)
+    length = 0
+    while True:
+        header = (await reader.readline()).decode('latin-1').strip()
+        if not header:
+            break
+        name, _, value = header.partition(':')
+        if name.strip().lower() == 'content-length':
+            length = int(value)
+    body = await reader.readexactly(length) if length else b''
+    return method, path, body
+
+
+def _http_response(status, payload):
+    body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+    return ('HTTP/1.1 {}\r\nContent-Type: application/json; charset=utf-8\r\n'
+            'Content-Length: {}\r\nConnection: close\r\n\r\n'.format(status, len(body))).encode('latin-1') + body
+
+
+def serve(options=DecodeOptions(), host='127.0.0.1', port=8080, unix_socket=None,
+          max_wait_ms=SERVER_MAX_WAIT_MS, cache=None, cache_file=None, lazy=LAZY_BUILD, frozen=None):
+    """ Long-lived translation server. POST /translate with {"text": ...}
+    returns {"translation": ..., "latency_ms": ...}; GET /stats returns the
+    latency percentiles and batch fill of the micro-batcher. Cached
+    translations are answered without queueing """
+    _, enc_vocab = load_vocab(os.path.join(PROCESSED_PATH, 'vocab.en'))
+    inv_dec_vocab, dec_vocab = load_vocab(os.path.join(PROCESSED_PATH, 'vocab.vi'))
+    shortlist = _make_shortlist(options, enc_vocab, dec_vocab)
+    model, sess = _inference_session(DECODE_BATCH_SIZE, lazy, frozen)
+    max_length = BUCKETS[-1][0]
+
+    with sess:
+
+        def decode(token_ids_list):
+            return _translate_batch(sess, model, token_ids_list, inv_dec_vocab, options, shortlist=shortlist)
+
+        # created inside the event loop, asyncio primitives bind to it
+        batcher = None
+
+        async def handle(reader, writer):
+            try:
+                method, path, body = await _read_http_request(reader)
+                if method == 'GET' and path == '/stats':
+                    stats = batcher.stats()
+                    if cache is not None:
+                        stats['cache'] = cache.stats()
+                    response = _http_response('200 OK', stats)
+                elif method == 'POST' and path == '/translate':
+                    request = json.loads(body.decode('utf-8'))
+                    if not isinstance(request, dict):
+                        raise ValueError('the body must be a JSON object with a "text" field')
+                    line = request['text']
+                    token_ids = sentence2id(enc_vocab, str(line))
+                    if len(token_ids) > max_length:
+                        response = _http_response('413 Payload Too Large', {
+                            'error': 'sentence has {} tokens, the longest bucket takes {}'.format(
+                                len(token_ids), max_length)})
+                    else:
+                        translation = cache.get(token_ids, options) if cache is not None else None
+                        if translation is None:
+                            translation, latency = await batcher.translate(token_ids)
+                            if cache is not None:
+                                cache.put(token_ids, options, translation)
+                        else:
+                            latency = 0.0
+                        response = _http_response('200 OK', {'translation': translation,
+                                                             'latency_ms': latency * 1000})
+                else:
+                    response = _http_response('404 Not Found', {'error': 'unknown endpoint'})
+            except (ValueError, KeyError) as e:
+                response = _http_response('400 Bad Request', {'error': str(e)})
+            except Exception as e:
+                # e.g. a decode error handed over by the batcher
+                response = _http_response('500 Internal Server Error', {'error': '{}: {}'.format(
+                    type(e).__name__, e)})
+            try:
+                writer.write(response)
+                await writer.drain()
+            finally:
+                writer.close()
+
+        async def main_loop():
+            nonlocal batcher
+            batcher = MicroBatcher(decode, model.batch_size, max_wait_ms / 1000.0)
+            batcher_task = asyncio.ensure_future(batcher.run())
+            if unix_socket:
+                server = await asyncio.start_unix_server(handle, path=unix_socket)
+                print('Serving on ' + unix_socket)
+            else:
+                server = await asyncio.start_server(handle, host, port)
+                print('Serving on http://{}:{}'.format(host, port))
+            sys.stdout.flush()
+            async with server:
+                await server.serve_forever()
+            batcher_task.cancel()
+
+        try:
+            asyncio.run(main_loop())
+        except KeyboardInterrupt:
+            if batcher is not None:
+                print(json.dumps(batcher.stats()))
+        if cache is not None:
+            print('Cache: ' + json.dumps(cache.stats()))
+            if cache_file:
+                cache.save(cache_file)
 
 def main():
-    test()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('mode', choices=['train', 'test', 'translate', 'translate-file', 'serve', 'buckets', 'export'])
+    parser.add_argument('--buckets', help='load BUCKETS from a config saved by the buckets mode')
+    parser.add_argument('--num-buckets', type=int, default=len(BUCKETS), help='buckets: how many buckets to propose')
+    parser.add_argument('--max-encode', type=int, help='buckets: longest source sentence to keep, '
+                                                       'defaults to the largest current bucket')
+    parser.add_argument('--max-decode', type=int, help='buckets: longest target sentence to keep, '
+                                                       'defaults to the largest current bucket')
+    parser.add_argument('--input', default='-', help='translate-file: file to translate, - for stdin')
+    parser.add_argument('--output', help='buckets: save the proposed buckets to this config; '
+                                         'export: where to write the frozen graph, defaults to ' + FROZEN_PATH + '; '
+                                         'translate-file: where to write the translation, defaults to stdout')
+    parser.add_argument('--fp16', action='store_true', help='export: store proj_w and the embeddings as float16')
+    parser.add_argument('--frozen', help='test/translate/translate-file/serve: decode with a graph saved by the export mode')
+    parser.add_argument('--token-budget', type=int, default=TOKEN_BUDGET,
+                        help='train: tokens per batch (encoder + decoder bucket size per sentence) '
+                             'instead of a fixed BATCH_SIZE sentences')
+    parser.add_argument('--seed', type=int, default=SAMPLER_SEED, help='train: seed of the epoch shuffling')
+    parser.add_argument('--metrics', default=METRICS_PATH,
+                        help='train: append per-step metrics to this JSON lines file, empty to disable')
+    parser.add_argument('--replicas', type=int, default=REPLICAS,
+                        help='train: data-parallel replicas, one CPU device each, that train a batch each per step')
+    parser.add_argument('--patience', type=int, default=EARLY_STOP_PATIENCE,
+                        help='train: stop after this many validations without a lower loss, 0 never stops early')
+    parser.add_argument('--trace-steps', type=lambda steps: {int(step) for step in steps.split(',')}, default=set(),
+                        help='train: comma separated steps to save a chrome://tracing timeline of')
+    parser.add_argument('--beam-width', type=int, default=BEAM_WIDTH,
+                        help='beam search width for test/translate, 1 decodes greedily')
+    parser.add_argument('--length-penalty', type=float, default=LENGTH_PENALTY,
+                        help='GNMT length penalty alpha used to rank beams')
+    parser.add_argument('--unrolled', action='store_true',
+                        help='decode greedily with the unrolled bucket graph instead of step by step')
+    parser.add_argument('--shortlist', action='store_true',
+                        help='test/translate/translate-file/serve: only score the target words the {} lexicon '
+                             'suggests for the input, plus the most frequent ones'.format(LEXICON_PATH))
+    parser.add_argument('--eager-build', action='store_true',
+                        help='test/translate/translate-file/serve: build the graph of every bucket at startup '
+                             'instead of on first use')
+    parser.add_argument('--host', default='127.0.0.1', help='serve: address to listen on')
+    parser.add_argument('--port', type=int, default=8080, help='serve: port to listen on')
+    parser.add_argument('--unix-socket', help='serve: listen on this Unix socket instead of host:port')
+    parser.add_argument('--max-wait-ms', type=float, default=SERVER_MAX_WAIT_MS,
+                        help='serve: longest a request waits for its micro-batch to fill')
+    parser.add_argument('--cache-size', type=int, default=CACHE_MAX_ENTRIES,
+                        help='translate/translate-file/serve: cached translations to keep, 0 disables the cache')
+    parser.add_argument('--cache-ttl', type=float, help='translate/translate-file/serve: seconds a cached translation stays valid')
+    parser.add_argument('--cache-file', help='translate/serve: warm the cache from this file and save it on exit')
+    args = parser.parse_args()
+    if args.shortlist and args.unrolled:
+        parser.error('--shortlist needs the step-wise decoder, it cannot be used with --unrolled')
+    options = DecodeOptions(args.beam_width, args.length_penalty, not args.unrolled, args.shortlist)
+    if args.buckets:
+        load_buckets(args.buckets)
+
     if not os.path.isdir(CPT_PATH):
         #prepare_raw_data()
         process_data()
         # create checkpoints folder if there isn't one already
         os.mkdir(CPT_PATH)
 
-    if sys.argv[1] == 'train':
-        train()
-    elif sys.argv[1] == 'test':
-        test()
-    elif sys.argv[1] == 'translate':
-        translate()
+    if args.mode == 'train':
+        train(args.token_budget, args.seed, args.metrics, args.trace_steps, args.patience, args.replicas)
+    elif args.mode == 'test':
+        test(options, not args.eager_build, args.frozen)
+    elif args.mode == 'translate':
+        translate(options, _make_cache(args.cache_size, args.cache_ttl, args.cache_file, _model_id(args.frozen)),
+                  args.cache_file, not args.eager_build, args.frozen)
+    elif args.mode == 'translate-file':
+        translate_file(args.input, args.output or '-', options, _make_cache(args.cache_size, args.cache_ttl),
+                       not args.eager_build, args.frozen)
+    elif args.mode == 'serve':
+        serve(options, args.host, args.port, args.unix_socket, args.max_wait_ms,
+              _make_cache(args.cache_size, args.cache_ttl, args.cache_file, _model_id(args.frozen)), args.cache_file,
+              not args.eager_build, args.frozen)
+    elif args.mode == 'export':
+        export(args.output or FROZEN_PATH, args.fp16)
+    elif args.mode == 'buckets':
+        suggest_buckets(args.num_buckets, args.max_encode, args.max_decode, args.output)
 
 if __name__ == '__main__':
     main()
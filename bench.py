@@ -0,0 +1,431 @@
+""" Micro-benchmarks for the data and decoding paths of NMT.py.
+Usage: python bench.py <benchmark> [args] """
+import os
+import random
+import re
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+import bleu
+import NMT
+
+
+def _legacy_get_batch(data_bucket, bucket_id, batch_size=1):
+    """ The list based get_batch that BucketData replaced, kept as a reference """
+    encoder_size, decoder_size = NMT.BUCKETS[bucket_id]
+    encoder_inputs, decoder_inputs = [], []
+    for _ in range(batch_size):
+        encoder_input, decoder_input = random.choice(data_bucket)
+        encoder_inputs.append(list(reversed(encoder_input + [NMT.PAD_ID] * (encoder_size - len(encoder_input)))))
+        decoder_inputs.append(decoder_input + [NMT.PAD_ID] * (decoder_size - len(decoder_input)))
+
+    def reshape(inputs, size):
+        return [np.array([inputs[batch_id][length_id] for batch_id in range(batch_size)], dtype=np.int32)
+                for length_id in range(size)]
+
+    batch_masks = []
+    for length_id in range(decoder_size):
+        batch_mask = np.ones(batch_size, dtype=np.float32)
+        for batch_id in range(batch_size):
+            if length_id < decoder_size - 1:
+                target = decoder_inputs[batch_id][length_id + 1]
+            if length_id == decoder_size - 1 or target == NMT.PAD_ID:
+                batch_mask[batch_id] = 0.0
+        batch_masks.append(batch_mask)
+    return reshape(encoder_inputs, encoder_size), reshape(decoder_inputs, decoder_size), batch_masks
+
+
+def _legacy_basic_tokenizer(line, normalize_digits=True):
+    """ The four re.sub basic_tokenizer that Tokenizer replaced, kept as a reference """
+    line = re.sub('<u>', '', line)
+    line = re.sub('</u>', '', line)
+    line = re.sub('\\[', '', line)
+    line = re.sub('\\]', '', line)
+    words = []
+    _WORD_SPLIT = re.compile("([.,!?\"'-<>:;)(])")
+    _DIGIT_RE = re.compile(r"\d")
+    for fragment in line.strip().lower().split():
+        for token in re.split(_WORD_SPLIT, fragment):
+            if not token:
+                continue
+            if normalize_digits:
+                token = re.sub(_DIGIT_RE, '#', token)
+            words.append(token)
+    return words
+
+
+def _read_pairs(enc_filename, dec_filename):
+    """ Bucketed [encode_ids, decode_ids] lists, as the text loader used to keep them """
+    pairs = [[] for _ in NMT.BUCKETS]
+    with open(os.path.join(NMT.PROCESSED_PATH, enc_filename)) as encode_file, \
+            open(os.path.join(NMT.PROCESSED_PATH, dec_filename)) as decode_file:
+        for encode, decode in zip(encode_file, decode_file):
+            encode_ids = [int(id_) for id_ in encode.split()]
+            decode_ids = [int(id_) for id_ in decode.split()]
+            for bucket_id, (encode_max_size, decode_max_size) in enumerate(NMT.BUCKETS):
+                if len(encode_ids) <= encode_max_size and len(decode_ids) <= decode_max_size:
+                    pairs[bucket_id].append([encode_ids, decode_ids])
+                    break
+    return pairs
+
+
+def bench_get_batch(data='tst2012', repeats=50):
+    """ Batch build time per bucket, legacy lists vs BucketData """
+    repeats = int(repeats)
+    pairs = _read_pairs(data + '_ids.en', data + '_ids.vi')
+    buckets = NMT.load_data(data + '_ids.en', data + '_ids.vi')
+    print('bucket  samples  legacy ms  numpy ms  speedup  identical')
+    for bucket_id, bucket in enumerate(buckets):
+        if not len(bucket):
+            continue
+        random.seed(bucket_id)
+        start = time.time()
+        for _ in range(repeats):
+            legacy = _legacy_get_batch(pairs[bucket_id], bucket_id, NMT.BATCH_SIZE)
+        legacy_time = (time.time() - start) / repeats
+
+        random.seed(bucket_id)
+        start = time.time()
+        for _ in range(repeats):
+            batch = NMT.get_batch(bucket, bucket_id, NMT.BATCH_SIZE)
+        numpy_time = (time.time() - start) / repeats
+
+        identical = all(np.array_equal(np.stack(old), new) and np.stack(old).dtype == new.dtype
+                        for old, new in zip(legacy, batch))
+        print('{:6d}  {:7d}  {:9.3f}  {:8.3f}  {:6.1f}x  {}'.format(
+            bucket_id, len(bucket), legacy_time * 1000, numpy_time * 1000,
+            legacy_time / numpy_time, identical))
+
+
+def bench_tokenizer(*filenames):
+    """ Lines/sec of the legacy tokenizer vs Tokenizer.tokenize_many """
+    filenames = filenames or ['tst2012.en', 'tst2012.vi', 'dict.en-vi']
+    tokenizer = NMT.Tokenizer()
+    print('file          lines  legacy l/s      fast l/s  speedup  identical')
+    for filename in filenames:
+        with open(os.path.join(NMT.PROCESSED_PATH, filename)) as f:
+            lines = f.read().splitlines()
+        start = time.time()
+        legacy = [_legacy_basic_tokenizer(line) for line in lines]
+        legacy_time = time.time() - start
+        start = time.time()
+        fast = tokenizer.tokenize_many(lines)
+        fast_time = time.time() - start
+        print('{:12s} {:6d}  {:10.0f}  {:12.0f}  {:6.1f}x  {}'.format(
+            filename, len(lines), len(lines) / legacy_time, len(lines) / fast_time,
+            legacy_time / fast_time, legacy == fast))
+
+
+def bench_bleu(workers=1, data='tst2012.vi'):
+    """ nltk sentence_bleu loop vs bleu.py on a shuffled copy of a corpus """
+    import warnings
+    from nltk.translate.bleu_score import corpus_bleu, sentence_bleu, SmoothingFunction
+    warnings.simplefilter('ignore')
+    with open(os.path.join(NMT.PROCESSED_PATH, data)) as f:
+        references = [line.split() for line in f]
+    rng = random.Random(0)
+    hypotheses = [rng.sample(reference, len(reference) * 3 // 4) for reference in references]
+
+    start = time.time()
+    nltk_scores = [sentence_bleu([reference], hypothesis, smoothing_function=SmoothingFunction().method1)
+                   for reference, hypothesis in zip(references, hypotheses)]
+    nltk_corpus = corpus_bleu([[reference] for reference in references], hypotheses)
+    nltk_time = time.time() - start
+
+    start = time.time()
+    stats = bleu.corpus_stats(references, hypotheses, workers=int(workers))
+    scores = bleu.sentence_scores(stats)
+    corpus = bleu.corpus_bleu(stats)
+    fast_time = time.time() - start
+
+    print('nltk     {:.3f}s  average {:.6f}  corpus {:.6f}'.format(
+        nltk_time, sum(nltk_scores) / len(nltk_scores), nltk_corpus))
+    print('bleu.py  {:.3f}s  average {:.6f}  corpus {:.6f}'.format(
+        fast_time, sum(scores) / len(scores), corpus))
+    print('speedup {:.1f}x, max sentence difference {:.2e}'.format(
+        nltk_time / fast_time, max(abs(a - b) for a, b in zip(nltk_scores, scores))))
+
+
+def _measure(func):
+    """ Wall time and peak traced Python/NumPy allocation of func() """
+    tracemalloc.start()
+    start = time.time()
+    result = func()
+    elapsed = time.time() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def bench_load_data(data='tst2012'):
+    """ Text loader vs the memory-mapped binary loader """
+    enc_filename, dec_filename = data + '_ids.en', data + '_ids.vi'
+    for filename in [enc_filename, dec_filename]:
+        if NMT._map_ids(filename)[0] is None:
+            NMT._text_ids_to_binary(filename)
+    text, text_time, text_peak = _measure(
+        lambda: NMT.load_data(enc_filename, dec_filename, use_binary=False))
+    binary, binary_time, binary_peak = _measure(lambda: NMT.load_data(enc_filename, dec_filename))
+    identical = all(np.array_equal(a.encoder, b.encoder) and np.array_equal(a.decoder, b.decoder)
+                    for a, b in zip(text, binary))
+    print('loader  seconds  peak MB')
+    print('text    {:7.3f}  {:7.1f}'.format(text_time, text_peak / 2 ** 20))
+    print('binary  {:7.3f}  {:7.1f}'.format(binary_time, binary_peak / 2 ** 20))
+    print('speedup {:.1f}x, identical buckets: {}'.format(text_time / binary_time, identical))
+
+
+def bench_build_graph(batch_size=1):
+    """ Startup graph build time of the inference model, every bucket vs lazy """
+    print('build   seconds')
+    for lazy in [False, True]:
+        NMT.tf.reset_default_graph()
+        model = NMT.ChatBotModel(True, int(batch_size), lazy=lazy)
+        start = time.time()
+        model.build_graph()
+        print('{:6s}  {:7.2f}'.format('lazy' if lazy else 'eager', time.time() - start))
+
+
+def bench_cold_start(frozen=NMT.FROZEN_PATH, sentence='thank you very much .'):
+    """ Seconds to the first translation, checkpoint vs graph saved by export """
+    _, enc_vocab = NMT.load_vocab(os.path.join(NMT.PROCESSED_PATH, 'vocab.en'))
+    inv_dec_vocab, _ = NMT.load_vocab(os.path.join(NMT.PROCESSED_PATH, 'vocab.vi'))
+    token_ids = NMT.sentence2id(enc_vocab, sentence)
+    print('model       load s  first s  translation')
+    for name, path in [('checkpoint', None), ('frozen', frozen)]:
+        NMT.tf.reset_default_graph()
+        start = time.time()
+        model, sess = NMT._inference_session(1, frozen=path)
+        loaded = time.time()
+        with sess:
+            response = NMT._translate_batch(sess, model, [token_ids], inv_dec_vocab)[0]
+        print('{:10s}  {:6.2f}  {:7.2f}  {}'.format(name, loaded - start, time.time() - loaded, response))
+
+
+def bench_beam(beam_widths='2,4', data='tst2012'):
+    """ Decoding time and BLEU of greedy decoding (unrolled and step-wise) vs
+    beam search on a test set, with every time relative to step-wise greedy.
+    Needs a trained model """
+    _, enc_vocab = NMT.load_vocab(os.path.join(NMT.PROCESSED_PATH, 'vocab.en'))
+    inv_dec_vocab, _ = NMT.load_vocab(os.path.join(NMT.PROCESSED_PATH, 'vocab.vi'))
+    with open(os.path.join(NMT.PROCESSED_PATH, data + '.en')) as f:
+        sources = [NMT.sentence2id(enc_vocab, line) for line in f]
+    with open(os.path.join(NMT.PROCESSED_PATH, data + '.vi')) as f:
+        references = [line.split() for line in f]
+    kept = [i for i, token_ids in enumerate(sources) if len(token_ids) <= NMT.BUCKETS[-1][0]]
+    runs = [('greedy', NMT.DecodeOptions()), ('greedy unrolled', NMT.DecodeOptions(incremental=False))]
+    runs += [('beam {}'.format(width), NMT.DecodeOptions(beam_width=width))
+             for width in map(int, beam_widths.split(','))]
+
+    model, sess = NMT._inference_session(NMT.DECODE_BATCH_SIZE)
+    print('decoder          seconds  vs greedy  corpus BLEU')
+    with sess:
+        base = None
+        for name, options in runs:
+            # build every bucket before timing
+            NMT._translate_batch(sess, model, [[NMT.UNK_ID] * encoder_size for encoder_size, _ in NMT.BUCKETS],
+                                 inv_dec_vocab, options)
+            start = time.time()
+            responses = NMT._translate_batch(sess, model, [sources[i] for i in kept], inv_dec_vocab, options)
+            elapsed = time.time() - start
+            base = base or elapsed
+            stats = bleu.corpus_stats([references[i] for i in kept], [response.split() for response in responses])
+            print('{:15s}  {:7.2f}  {:8.2f}x  {:.4f}'.format(name, elapsed, elapsed / base, bleu.corpus_bleu(stats)))
+
+
+def bench_shortlist(data='tst2012', decode=False):
+    """ Shortlist size and coverage of the reference words on a test set and,
+    with decode=1 and a trained model, the BLEU and time of decoding with and
+    without it """
+    _, enc_vocab = NMT.load_vocab(os.path.join(NMT.PROCESSED_PATH, 'vocab.en'))
+    inv_dec_vocab, dec_vocab = NMT.load_vocab(os.path.join(NMT.PROCESSED_PATH, 'vocab.vi'))
+    shortlist = NMT.Shortlist(enc_vocab, dec_vocab)
+    with open(os.path.join(NMT.PROCESSED_PATH, data + '.en')) as f:
+        sources = [NMT.sentence2id(enc_vocab, line) for line in f]
+    with open(os.path.join(NMT.PROCESSED_PATH, data + '.vi')) as f:
+        references = [line.split() for line in f]
+    kept = [i for i, token_ids in enumerate(sources) if len(token_ids) <= NMT.BUCKETS[-1][0]]
+
+    sizes, covered, total = [], 0, 0
+    for start in range(0, len(kept), NMT.DECODE_BATCH_SIZE):
+        chunk = kept[start:start + NMT.DECODE_BATCH_SIZE]
+        candidates = set(shortlist.candidates([sources[i] for i in chunk]).tolist())
+        sizes.append(len(candidates))
+        for i in chunk:
+            reference_ids = [dec_vocab.get(token, NMT.UNK_ID) for token in NMT.basic_tokenizer(' '.join(references[i]))]
+            covered += sum(id_ in candidates for id_ in reference_ids)
+            total += len(reference_ids)
+    print('shortlist of {} batches: {:.0f} of {} words on average, covers {:.1%} of the reference tokens'.format(
+        len(sizes), sum(sizes) / len(sizes), NMT.DEC_VOCAB, covered / total))
+    if not int(decode):
+        return
+
+    model, sess = NMT._inference_session(NMT.DECODE_BATCH_SIZE)
+    with sess:
+        for use_shortlist in [False, True]:
+            start = time.time()
+            responses = NMT._translate_batch(sess, model, [sources[i] for i in kept], inv_dec_vocab,
+                                             NMT.DecodeOptions(shortlist=use_shortlist), shortlist=shortlist)
+            elapsed = time.time() - start
+            stats = bleu.corpus_stats([references[i] for i in kept], [response.split() for response in responses])
+            print('{:9s}  {:6.2f}s  corpus BLEU {:.4f}'.format(
+                'shortlist' if use_shortlist else 'full', elapsed, bleu.corpus_bleu(stats)))
+
+
+class _StubDecoder:
+    """ Stands in for both the model and the session of the step-wise decoders:
+    a fixed random table gives the log-probabilities of the next token given
+    the previous one. Checks the dtype and shape of what the decoders feed """
+    def __init__(self, vocab_size=50, seed=0):
+        rng = np.random.RandomState(seed)
+        logits = rng.randn(vocab_size, vocab_size)
+        logits[:, NMT.EOS_ID] -= 1.0
+        self.table = logits - np.log(np.exp(logits).sum(axis=1, keepdims=True))
+        self.encoder_inputs = ['encoder_input{}'.format(i) for i in range(NMT.BUCKETS[-1][0])]
+        self.step_inputs, self.step_k, self.shortlist = 'step_inputs', 'step_k', 'shortlist'
+        self.step_state = ['step_state']
+        self.encoder_attention = [('attention', i) for i in range(len(NMT.BUCKETS))]
+        self.encoder_state = [('state', i) for i in range(len(NMT.BUCKETS))]
+        self.step_attention = ['step_attention{}'.format(i) for i in range(len(NMT.BUCKETS))]
+        for name in ['step_outputs', 'step_greedy', 'step_shortlist_outputs', 'step_shortlist_greedy']:
+            setattr(self, name, [[(name, i, first) for first in range(2)] for i in range(len(NMT.BUCKETS))])
+
+    def build_decoder_step(self, bucket_id):
+        pass
+
+    def run(self, fetches, feed):
+        if isinstance(fetches, list):
+            rows = len(feed[self.encoder_inputs[0]])
+            return np.zeros((rows, NMT.BUCKETS[-1][0], 4)), [np.zeros((rows, 4))]
+        name = fetches[0]
+        inputs = feed[self.step_inputs]
+        assert inputs.dtype == np.int32 and inputs.ndim == 1, 'step_inputs {} {}'.format(inputs.dtype, inputs.shape)
+        ids = np.arange(len(self.table))
+        if 'shortlist' in name:
+            ids = feed[self.shortlist]
+            assert ids.dtype == np.int32 and ids.ndim == 1, 'shortlist {} {}'.format(ids.dtype, ids.shape)
+        log_probs = self.table[inputs][:, ids]
+        state = [feed['step_state'] + 1]
+        if 'greedy' in name:
+            return ids[np.argmax(log_probs, axis=1)].astype(np.int32), state
+        # stable, so ties go to the lower id like tf.nn.top_k
+        top = np.argsort(-log_probs, axis=1, kind='stable')[:, :feed[self.step_k]]
+        return np.take_along_axis(log_probs, top, axis=1), ids[top].astype(np.int32), state
+
+
+def bench_decode_stub(bucket_id=0, batch_size=3):
+    """ Regression check of _greedy_decode and _beam_search with beam_width
+    1, 2 and 4, with and without a shortlist, on _StubDecoder. No TensorFlow
+    session runs, so it needs no model """
+    bucket_id, batch_size = int(bucket_id), int(batch_size)
+    stub = _StubDecoder()
+    rng = random.Random(0)
+    token_ids_list = [[rng.randrange(4, 50) for _ in range(rng.randint(1, NMT.BUCKETS[bucket_id][0]))]
+                      for _ in range(batch_size)]
+    shortlist_ids = np.array([NMT.PAD_ID, NMT.EOS_ID] + list(range(10, 30)), dtype=np.int32)
+    for name, ids in [('full', None), ('shortlist', shortlist_ids)]:
+        greedy = NMT._greedy_decode(stub, stub, token_ids_list, bucket_id, ids)
+        for beam_width in [1, 2, 4]:
+            outputs = NMT._beam_search(stub, stub, token_ids_list, bucket_id, beam_width, shortlist_ids=ids)
+            assert len(outputs) == batch_size
+            if ids is not None:
+                assert set(sum(outputs, [])) <= set(ids.tolist()), 'beam search left the shortlist'
+            if beam_width == 1:
+                assert outputs == greedy, 'beam_width=1 differs from greedy decoding'
+            print('{:9s}  beam {}  ok  {}'.format(name, beam_width, outputs[0]))
+
+
+def bench_serve(requests=512, clients=64, batch_sizes='16,64', max_waits_ms='0,5,10,50', data='tst2012'):
+    """ Throughput and the /stats latency percentiles of the serve mode's
+    MicroBatcher as batch size and max wait change. clients concurrent
+    clients send the first requests sentences of data one at a time, without
+    the HTTP layer and with no cache. Needs a trained model """
+    requests, clients = int(requests), int(clients)
+    _, enc_vocab = NMT.load_vocab(os.path.join(NMT.PROCESSED_PATH, 'vocab.en'))
+    inv_dec_vocab, _ = NMT.load_vocab(os.path.join(NMT.PROCESSED_PATH, 'vocab.vi'))
+    with open(os.path.join(NMT.PROCESSED_PATH, data + '.en')) as f:
+        sources = [token_ids for token_ids in (NMT.sentence2id(enc_vocab, line) for line in f)
+                   if 0 < len(token_ids) <= NMT.BUCKETS[-1][0]][:requests]
+
+    async def run(batcher):
+        batcher_task = NMT.asyncio.ensure_future(batcher.run())
+        queue = list(reversed(sources))
+
+        async def client():
+            while queue:
+                await batcher.translate(queue.pop())
+
+        start = time.time()
+        await NMT.asyncio.gather(*[client() for _ in range(clients)])
+        elapsed = time.time() - start
+        batcher_task.cancel()
+        return elapsed
+
+    print('batch  max wait ms  sentences/sec  mean fill  p50 ms  p90 ms  p99 ms')
+    for batch_size in map(int, batch_sizes.split(',')):
+        NMT.tf.reset_default_graph()
+        model, sess = NMT._inference_session(batch_size)
+        with sess:
+            def decode(token_ids_list):
+                return NMT._translate_batch(sess, model, token_ids_list, inv_dec_vocab)
+
+            # build every bucket before timing
+            decode([[NMT.UNK_ID] * encoder_size for encoder_size, _ in NMT.BUCKETS])
+            for max_wait_ms in map(float, max_waits_ms.split(',')):
+                batcher = NMT.MicroBatcher(decode, batch_size, max_wait_ms / 1000.0)
+                elapsed = NMT.asyncio.run(run(batcher))
+                stats = batcher.stats()
+                print('{:5d}  {:11.1f}  {:13.1f}  {:9.2f}  {:6.1f}  {:6.1f}  {:6.1f}'.format(
+                    batch_size, max_wait_ms, len(sources) / elapsed, stats['mean_batch_fill'],
+                    stats['p50_latency_ms'], stats['p90_latency_ms'], stats['p99_latency_ms']))
+
+
+def _training_rate(bucket, bucket_id, replicas, batch_size, steps):
+    """ Training examples/sec of a model with replicas replicas, each training
+    a batch_size batch per step """
+    NMT.tf.reset_default_graph()
+    model = NMT.ChatBotModel(False, batch_size, lazy=True, replicas=replicas)
+    model.build_graph()
+    model.build_bucket(bucket_id)
+    rng = random.Random(0)
+    batches = [NMT.get_batch(bucket, bucket_id, batch_size * replicas, rng) for _ in range(steps + 2)]
+    with NMT.tf.Session(config=NMT._session_config(replicas)) as sess:
+        sess.run(NMT.tf.global_variables_initializer())
+        for step, batch in enumerate(batches):
+            # the first two steps warm up
+            if step == 2:
+                start = time.time()
+            NMT.run_step(sess, model, *batch, bucket_id, False)
+        return steps * batch_size * replicas / (time.time() - start)
+
+
+def bench_data_parallel(max_replicas=os.cpu_count(), steps=20, bucket_id=0, data='tst2012'):
+    """ Training examples/sec of one bucket as data-parallel replicas go from
+    1 to max_replicas, each replica training a BATCH_SIZE batch per step.
+    The CPU devices share one thread pool, so every row is also compared to a
+    single replica training the same replicas * BATCH_SIZE batch """
+    max_replicas, steps, bucket_id = int(max_replicas), int(steps), int(bucket_id)
+    bucket = NMT.load_data(data + '_ids.en', data + '_ids.vi')[bucket_id]
+    replicas_list = sorted({1 << i for i in range(max_replicas.bit_length())} | {max_replicas})
+    print('replicas  examples/sec  scaling  1 replica same batch  vs 1 replica')
+    base = None
+    for replicas in replicas_list:
+        rate = _training_rate(bucket, bucket_id, replicas, NMT.BATCH_SIZE, steps)
+        base = base or rate
+        single = rate if replicas == 1 else _training_rate(bucket, bucket_id, 1, NMT.BATCH_SIZE * replicas, steps)
+        print('{:8d}  {:12.1f}  {:6.2f}x  {:20.1f}  {:10.2f}x'.format(replicas, rate, rate / base, single,
+                                                                      rate / single))
+
+
+def main():
+    benchmarks = {name[len('bench_'):]: func for name, func in globals().items()
+                  if name.startswith('bench_')}
+    if len(sys.argv) < 2 or sys.argv[1] not in benchmarks:
+        print('Usage: python bench.py {' + '|'.join(sorted(benchmarks)) + '} [args]')
+        sys.exit(1)
+    benchmarks[sys.argv[1]](*sys.argv[2:])
+
+if __name__ == '__main__':
+    main()
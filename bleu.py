@@ -0,0 +1,130 @@
+""" Fast BLEU for single-reference corpora. The n-grams of the whole corpus are
+extracted once into integer arrays and matched with a sort, which gives the
+clipped matches of every sentence pair. Both the sentence-level and the
+corpus-level scores are computed from those statistics. The scores are the ones
+nltk.translate.bleu_score computes, with SmoothingFunction().method1 when
+smoothing is on and the default method0 when it is off. """
+import math
+import multiprocessing
+import sys
+
+import numpy as np
+
+MAX_ORDER = 4
+EPSILON = 0.1  # method1 epsilon
+CHUNK_SIZE = 2000
+
+
+def _flatten(sentences, vocab):
+    """ Token ids of all the sentences, the sentence of every token and the
+    sentence lengths """
+    lengths = np.array([len(sentence) for sentence in sentences], dtype=np.int64)
+    ids = np.array([vocab.setdefault(token, len(vocab)) for sentence in sentences for token in sentence],
+                   dtype=np.int64)
+    return ids, np.repeat(np.arange(len(sentences)), lengths), lengths
+
+
+def _ngram_codes(ids, sentence_of, max_order):
+    """ For every order, the sentence and an exact integer code of every
+    n-gram. Codes are renumbered densely after each order so they never
+    overflow """
+    codes, result = ids, []
+    vocab_size = int(ids.max()) + 1 if len(ids) else 1
+    for n in range(1, max_order + 1):
+        if n > 1:
+            # an n-gram is the (n-1)-gram at i followed by the token at i + n - 1
+            valid = sentence_of[n - 1:] == sentence_of[:len(sentence_of) - n + 1]
+            _, dense = np.unique(codes[:len(valid)], return_inverse=True)
+            codes = np.where(valid, dense.reshape(-1) * vocab_size + ids[n - 1:], -1)
+        kept = codes >= 0
+        result.append((sentence_of[:len(codes)][kept], codes[kept]))
+    return result
+
+
+def _chunk_stats(pairs, max_order=MAX_ORDER):
+    vocab = {}
+    reference_ids, reference_of, reference_lengths = _flatten([pair[0] for pair in pairs], vocab)
+    hypothesis_ids, hypothesis_of, hypothesis_lengths = _flatten([pair[1] for pair in pairs], vocab)
+    # encode both sides together so that their n-gram codes agree,
+    # hypotheses are numbered after the references
+    ids = np.concatenate([reference_ids, hypothesis_ids])
+    sentence_of = np.concatenate([reference_of, hypothesis_of + len(pairs)])
+    matches = np.zeros((len(pairs), max_order), dtype=np.int64)
+    for n, (sentences, codes) in enumerate(_ngram_codes(ids, sentence_of, max_order)):
+        if not len(codes):
+            continue
+        is_hypothesis = sentences >= len(pairs)
+        # one key per (pair, n-gram), codes are dense so this stays well inside int64
+        keys = codes * len(pairs) + np.where(is_hypothesis, sentences - len(pairs), sentences)
+        hypothesis_keys, hypothesis_counts = np.unique(keys[is_hypothesis], return_counts=True)
+        reference_keys, reference_counts = np.unique(keys[~is_hypothesis], return_counts=True)
+        common, in_hypothesis, in_reference = np.intersect1d(hypothesis_keys, reference_keys, assume_unique=True,
+                                                             return_indices=True)
+        clipped = np.minimum(hypothesis_counts[in_hypothesis], reference_counts[in_reference])
+        matches[:, n] = np.bincount(common % len(pairs), weights=clipped, minlength=len(pairs))
+    return matches, reference_lengths, hypothesis_lengths
+
+
+def corpus_stats(references, hypotheses, workers=1, chunk_size=CHUNK_SIZE):
+    """ (clipped matches [pairs, MAX_ORDER], reference lengths, hypothesis
+    lengths) of every (reference, hypothesis) pair. With a single reference the
+    clipped matches are symmetric, so the same stats score a pair in either
+    direction. Chunks are scored in parallel when workers > 1 """
+    pairs = list(zip(references, hypotheses))
+    chunks = [pairs[i:i + chunk_size] for i in range(0, len(pairs), chunk_size)] or [[]]
+    if workers > 1 and len(chunks) > 1:
+        with multiprocessing.Pool(workers) as pool:
+            results = pool.map(_chunk_stats, chunks)
+    else:
+        results = [_chunk_stats(chunk) for chunk in chunks]
+    return tuple(np.concatenate(column) for column in zip(*results))
+
+
+def ngram_totals(hypothesis_length, max_order=MAX_ORDER):
+    """ Hypothesis n-grams per order. Like nltk, clamped to 1 when the
+    hypothesis is shorter than n """
+    return [max(1, hypothesis_length - n) for n in range(max_order)]
+
+
+def bleu(matches, totals, reference_length, hypothesis_length, smoothing=False):
+    """ BLEU with uniform weights from (summed) matches and n-gram totals """
+    max_order = len(matches)
+    if matches[0] == 0:
+        return 0
+    if hypothesis_length > reference_length:
+        brevity_penalty = 1
+    else:
+        brevity_penalty = math.exp(1 - reference_length / hypothesis_length)
+    log_precisions = []
+    for match, total in zip(matches, totals):
+        if match:
+            precision = match / total
+        elif smoothing:
+            precision = EPSILON / total
+        else:
+            precision = sys.float_info.min
+        log_precisions.append(1.0 / max_order * math.log(precision))
+    return brevity_penalty * math.exp(math.fsum(log_precisions))
+
+
+def sentence_scores(stats, smoothing=True):
+    """ The sentence BLEU of every pair in corpus_stats """
+    matches, reference_lengths, hypothesis_lengths = stats
+    return [bleu(row, ngram_totals(hypothesis_length, len(row)), reference_length, hypothesis_length, smoothing)
+            for row, reference_length, hypothesis_length in zip(matches.tolist(), reference_lengths.tolist(),
+                                                                hypothesis_lengths.tolist())]
+
+
+def sentence_bleu(reference, hypothesis, smoothing=True):
+    return sentence_scores(corpus_stats([reference], [hypothesis]), smoothing)[0]
+
+
+def corpus_bleu(stats, smoothing=False):
+    """ Corpus BLEU: matches, n-gram totals and lengths are summed over the
+    corpus before computing the precisions """
+    matches, reference_lengths, hypothesis_lengths = stats
+    if not len(matches):
+        return 0
+    totals = np.maximum(1, hypothesis_lengths[:, None] - np.arange(matches.shape[1])).sum(axis=0)
+    return bleu(matches.sum(axis=0).tolist(), totals.tolist(), int(reference_lengths.sum()),
+                int(hypothesis_lengths.sum()), smoothing)